@@ -0,0 +1,124 @@
+"""
+Offline handling of the data files written by OpTraceHook(data_dir=...).
+
+    python -m OpTrace combine -o combined.data .optrace/
+    python -m OpTrace report combined.data
+    python -m OpTrace report --hot 20 .optrace/
+    python -m OpTrace export --format lcov -o coverage.info .optrace/
+    python -m OpTrace collect --listen 127.0.0.1:7071 -o collected.data
+"""
+import argparse
+import os
+import sys
+
+from OpTrace.collector import Collector, parse_address
+from OpTrace.datafile import DataFile
+from OpTrace.exporters import EXPORTERS
+from OpTrace.reporter import CommonReporter, HotReporter
+
+
+def iter_paths(names):
+    # directories stand for the data files directly in them
+    for name in names:
+        if not os.path.isdir(name):
+            yield name
+            continue
+        for item in sorted(os.listdir(name)):
+            if item.startswith(DataFile.PREFIX) and item.endswith(DataFile.SUFFIX):
+                yield os.path.join(name, item)
+
+
+def combine(args):
+    data_file = DataFile()
+    entries = data_file.combine(iter_paths(args.paths))
+    data_file.write(args.output, entries)
+
+
+def report(args):
+    data_file = DataFile()
+    module_opcodes = {}
+    data_file.merge(data_file.combine(iter_paths(args.paths)), module_opcodes)
+    if args.hot:
+        HotReporter(module_opcodes, args.hot).report()
+    else:
+        CommonReporter(module_opcodes, args.workers).report()
+
+
+def export(args):
+    data_file = DataFile()
+    module_opcodes = {}
+    data_file.merge(data_file.combine(iter_paths(args.paths)), module_opcodes)
+    exporter = EXPORTERS[args.format]
+    if args.output == '-':
+        exporter(sys.stdout).export(module_opcodes)
+        return
+    with open(args.output, 'w') as file:
+        exporter(file).export(module_opcodes)
+
+
+def collect(args):
+    collector = Collector(parse_address(args.listen))
+    print('Collecting on {}, Ctrl-C to stop'.format(args.listen))
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.stop()
+    if args.output:
+        data_file = DataFile()
+        data_file.write(args.output, [
+            (module,) + data_file.encode(data)
+            for module, data in sorted(collector.module_opcodes.items())
+        ])
+    else:
+        CommonReporter(collector.module_opcodes).report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m OpTrace', description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    combine_parser = commands.add_parser(
+        'combine', help='OR many data files into one')
+    combine_parser.add_argument('paths', nargs='+', help='files or directories')
+    combine_parser.add_argument('-o', '--output', required=True)
+    combine_parser.set_defaults(func=combine)
+
+    report_parser = commands.add_parser(
+        'report', help='print the report of one or more data files')
+    report_parser.add_argument('paths', nargs='+', help='files or directories')
+    report_parser.add_argument(
+        '--hot', type=int, default=0, metavar='TOP',
+        help='list the TOP hottest opcodes and lines instead')
+    report_parser.add_argument(
+        '--workers', type=int, default=None,
+        help='analyze modules in this many processes')
+    report_parser.set_defaults(func=report)
+
+    export_parser = commands.add_parser(
+        'export', help='write json, lcov or cobertura xml')
+    export_parser.add_argument('paths', nargs='+', help='files or directories')
+    export_parser.add_argument(
+        '--format', default='json', choices=list(EXPORTERS))
+    export_parser.add_argument(
+        '-o', '--output', default='-', help='file to write, - for stdout')
+    export_parser.set_defaults(func=export)
+
+    collect_parser = commands.add_parser(
+        'collect', help='gather the coverage that hooks stream to a socket')
+    collect_parser.add_argument(
+        '--listen', required=True, help='host:port or a Unix socket path')
+    collect_parser.add_argument(
+        '-o', '--output', help='data file to write on exit, else report')
+    collect_parser.set_defaults(func=collect)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a command is required')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
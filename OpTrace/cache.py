@@ -0,0 +1,139 @@
+import hashlib
+import marshal
+import os
+import sys
+
+from array import array
+from importlib.util import cache_from_source, MAGIC_NUMBER
+from types import CodeType
+
+from OpTrace import __version__
+from OpTrace.wrapper import Wrapper
+
+
+class CodeCache:
+    """
+    Instrumented bytecode kept next to the regular bytecode cache, as
+    __pycache__/<module>.<tag>.optrace-<version>.pyc. The file holds the
+    instrumented module code together with the marker table (instruction
+    rows, hit map sizes and slot bounds), so a warm start skips both
+    wrap_code and the marker callbacks. Hit maps and the dirty flags are
+    marshalled as bytes and are replaced with live bytearrays on load.
+    """
+
+    def __init__(self, mode, granularity, dirty=False):
+        self.mode = mode
+        self.granularity = granularity
+        # whether the code sets dirty flags, which changes its bytecode
+        self.dirty = dirty
+
+    def get_path(self, source_path):
+        path = cache_from_source(source_path)
+        return '{}.optrace-{}.pyc'.format(
+            path[:-len('.pyc')], __version__)
+
+    def get_key(self, source_bytes):
+        key = hashlib.sha1('{} {} {} {}'.format(
+            __version__, self.mode, self.granularity, self.dirty).encode())
+        key.update(source_bytes)
+        return MAGIC_NUMBER + key.digest()
+
+    def make_table(self, data):
+        # every code object has its dirty flag, not always a hit map (see
+        # Wrapper.mark_blocks)
+        table = []
+        for codeobj_id, (_, instrumented) in sorted(data.codes.items()):
+            constants = instrumented.co_consts
+            dirty_index = next((
+                index for index, item in enumerate(constants)
+                if item is data.dirty
+            ), None)
+            if codeobj_id not in data.hits:
+                table.append((codeobj_id, None, dirty_index, 0, b'', []))
+                continue
+            hits, bounds = data.hits[codeobj_id]
+            hits_index = next(
+                index for index, item in enumerate(constants) if item is hits)
+            table.append((
+                codeobj_id, hits_index, dirty_index, len(hits),
+                bounds.tobytes(), data.get_rows(codeobj_id),
+            ))
+        return table
+
+    def dump(self, source_path, source_bytes, data, code):
+        if sys.dont_write_bytecode:
+            return
+        path = self.get_path(source_path)
+        try:
+            content = self.get_key(source_bytes) + marshal.dumps(
+                (code, self.make_table(data)))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = '{}.{}'.format(path, os.getpid())
+            with open(temp_path, 'wb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except (OSError, ValueError):
+            pass
+
+    def iter_codes(self, codeobj):
+        # same pre-order as Wrapper.get_codeobj_id hands out ids in
+        yield codeobj
+        for item in codeobj.co_consts:
+            if isinstance(item, CodeType):
+                yield from self.iter_codes(item)
+
+    def rebuild(self, codeobj, hits_indexes, codes, dirty):
+        codeobj_id = len(codes)
+        codes.append(None)
+        constants = [
+            self.rebuild(item, hits_indexes, codes, dirty)
+            if isinstance(item, CodeType) else item
+            for item in codeobj.co_consts
+        ]
+        if codeobj_id in hits_indexes:
+            hits_index, dirty_index, hits = hits_indexes[codeobj_id]
+            if hits_index is not None:
+                constants[hits_index] = hits
+            if dirty_index is not None:
+                constants[dirty_index] = dirty
+        codes[codeobj_id] = Wrapper.copy_code(
+            codeobj, co_consts=tuple(constants))
+        return codes[codeobj_id]
+
+    def load(self, source_path, source_bytes, data, original):
+        """Fill data from the cache and return the instrumented code or None."""
+        try:
+            with open(self.get_path(source_path), 'rb') as file:
+                content = file.read()
+        except OSError:
+            return None
+
+        key = self.get_key(source_bytes)
+        if not content.startswith(key):
+            return None
+        try:
+            code, table = marshal.loads(content[len(key):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+        hits_indexes = {}
+        for codeobj_id, hits_index, dirty_index, size, bounds, rows in table:
+            if hits_index is None:
+                hits_indexes[codeobj_id] = None, dirty_index, None
+                continue
+            hits = Wrapper.make_hit_map(size, self.mode == 'count')
+            hits_indexes[codeobj_id] = hits_index, dirty_index, hits
+            data.add_hits(codeobj_id, hits, array('L', bounds))
+            for row in rows:
+                data.add_row(codeobj_id, *row)
+
+        codes = []
+        self.rebuild(code, hits_indexes, codes, data.dirty)
+        # extended in place: the rebuilt code holds data.dirty itself
+        if len(data.dirty) < len(codes):
+            data.dirty.extend(bytes(len(codes) - len(data.dirty)))
+        originals = list(self.iter_codes(original))
+        # add_code expects nested code objects before their parents
+        for codeobj_id in reversed(range(len(codes))):
+            data.add_code(codeobj_id, originals[codeobj_id], codes[codeobj_id])
+        return codes[0]
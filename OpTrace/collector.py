@@ -0,0 +1,373 @@
+import json
+import socket
+import socketserver
+import struct
+import threading
+
+from array import array
+from importlib.util import MAGIC_NUMBER
+
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+FRAME = struct.Struct('<I')
+# the first message of a connection, with the bytecode magic number: rows
+# carry opcode numbers, which only mean the same to the same Python version
+HELLO = ['OpTrace collector', MAGIC_NUMBER.hex()]
+# a frame this long is not from a client, whatever it holds
+MAX_FRAME = 1 << 28
+
+
+def parse_address(text):
+    """'host:port' for TCP, anything else is a Unix socket path."""
+    host, _, port = text.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return text
+
+
+def send_message(sock, message):
+    payload = json.dumps(message, separators=(',', ':')).encode()
+    sock.sendall(FRAME.pack(len(payload)) + payload)
+
+
+def read_exactly(file, size):
+    data = file.read(size)
+    return data if len(data) == size else None
+
+
+def read_message(file):
+    """
+    The next message, or None once the peer is gone. Messages are JSON, so
+    reading one from an untrusted peer cannot run code; ValueError if it is
+    not JSON or too long.
+    """
+    header = read_exactly(file, FRAME.size)
+    if header is None:
+        return None
+    size = FRAME.unpack(header)[0]
+    if size > MAX_FRAME:
+        raise ValueError('Message of {} bytes is too long'.format(size))
+    payload = read_exactly(file, size)
+    if payload is None:
+        return None
+    return json.loads(payload.decode('utf-8'))
+
+
+def is_int(value, low=0, high=(1 << 64) - 1):
+    # bool is an int too, but never a valid count or id
+    return type(value) is int and low <= value <= high
+
+
+def is_row(row):
+    """(codeobj_id, offset, op, arg, line, argrepr, is_jump_target)"""
+    return (
+        isinstance(row, list) and len(row) == 7
+        and is_int(row[0], high=(1 << 32) - 1)
+        and is_int(row[1], high=(1 << 32) - 1)
+        and is_int(row[2], high=255)
+        and is_int(row[3], low=-1, high=(1 << 63) - 1)
+        and is_int(row[4], high=(1 << 32) - 1)
+        and isinstance(row[5], str)
+        and row[6] in (0, 1)
+    )
+
+
+def check_message(message):
+    """
+    Raise ValueError unless message is [counting, modules], every module
+    being [module, source or None, first, rows, probe ids, hits].
+    """
+    if not (isinstance(message, list) and len(message) == 2
+            and isinstance(message[0], bool)
+            and isinstance(message[1], list)):
+        raise ValueError('Malformed message')
+    for item in message[1]:
+        if not (isinstance(item, list) and len(item) == 6
+                and isinstance(item[0], str)
+                and (item[1] is None or isinstance(item[1], list)
+                     and all(isinstance(line, str) for line in item[1]))
+                and is_int(item[2], high=(1 << 32) - 1)
+                and isinstance(item[3], list)
+                and all(is_row(row) for row in item[3])
+                and isinstance(item[4], list) and isinstance(item[5], list)
+                and len(item[4]) == len(item[5])
+                and all(is_int(probe_id) for probe_id in item[4])
+                and all(is_int(hits) for hits in item[5])):
+            raise ValueError('Malformed module in message')
+
+
+class CollectorStore:
+    """
+    Coverage sent by every client, one FileOpcode per module. Probe ids
+    differ from process to process, so each connection sends the rows of a
+    module once and its hits by its own probe ids; the rows are added here
+    by (codeobj_id, offset) and the ids mapped per connection.
+    """
+
+    def __init__(self):
+        self.module_opcodes = {}
+        self.lock = threading.Lock()
+
+    def add(self, probe_maps, message):
+        """Add a message check_message has accepted."""
+        counting, modules = message
+        with self.lock:
+            # against the rows of this connection, before anything is added
+            sent = {}
+            for module, _, first, rows, probe_ids, _ in modules:
+                if first != sent.get(module, len(probe_maps.get(module, ()))):
+                    raise ValueError(
+                        'Rows of {} sent out of order'.format(module))
+                sent[module] = first + len(rows)
+                if probe_ids and max(probe_ids) >= sent[module]:
+                    raise ValueError(
+                        'Hits of {} for rows never sent'.format(module))
+
+            for module, source, first, rows, probe_ids, hits in modules:
+                data = self.module_opcodes.get(module)
+                if data is None:
+                    data = FileOpcode(module, source or [])
+                    self.module_opcodes[module] = data
+                elif source and not data.source:
+                    data.source = source
+                if counting and data.counts is None:
+                    data.counts = array('Q', [0]) * len(data)
+
+                probe_map = probe_maps.setdefault(module, array('L'))
+                for row in rows:
+                    probe_map.append(data.add_row(*row))
+
+                for probe_id, count in zip(probe_ids, hits):
+                    probe_id = probe_map[probe_id]
+                    data.visited[probe_id] = 1
+                    if counting:
+                        data.counts[probe_id] += count
+
+
+class CollectorHandler(socketserver.StreamRequestHandler):
+    def accept(self):
+        """Read the hello of the client and answer [accepted, reason]."""
+        hello = read_message(self.rfile)
+        if hello is None:
+            return False
+        if hello == HELLO:
+            send_message(self.request, [True, None])
+            return True
+        if isinstance(hello, list) and hello[:1] == HELLO[:1]:
+            reason = (
+                'the collector runs another Python version, bytecode magic '
+                '{}'.format(HELLO[1]))
+        else:
+            reason = 'not an OpTrace collector client'
+        send_message(self.request, [False, reason])
+        return False
+
+    def handle(self):
+        try:
+            if not self.accept():
+                return
+        except (OSError, ValueError):
+            return
+        probe_maps = {}
+        while True:
+            try:
+                message = read_message(self.rfile)
+                if message is None:
+                    return
+                check_message(message)
+                self.server.store.add(probe_maps, message)
+            except ValueError:
+                # not a client of ours, or a broken one: drop the
+                # connection, what it sent before stays
+                return
+
+
+class TCPCollectorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixCollectorServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Collector:
+    """
+    Server that ORs the coverage streamed by OpTraceHook(collector=...)
+    clients into one store; `module_opcodes` can be handed to any reporter.
+    """
+
+    def __init__(self, address):
+        self.store = CollectorStore()
+        server_class = (
+            UnixCollectorServer if isinstance(address, str)
+            else TCPCollectorServer)
+        self.server = server_class(address, CollectorHandler)
+        self.server.store = self.store
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    @property
+    def module_opcodes(self):
+        return self.store.module_opcodes
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name='OpTraceCollector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+
+class CollectorClient:
+    """
+    Sends the snapshots of a hook to a Collector every interval seconds,
+    from a daemon thread: instrumented code never waits on the network.
+    Whatever cannot be sent is kept and goes with the next attempt, over
+    a new connection.
+    """
+
+    def __init__(self, hook, address, interval=1.0, timeout=5.0):
+        self.hook = hook
+        self.address = address
+        self.interval = interval
+        self.timeout = timeout
+        # module -> {probe_id: hits} not sent yet
+        self.pending = {}
+        # module -> rows the collector has over the current connection
+        self.sent = {}
+        # why the collector refused this client; nothing is sent then
+        self.refused = None
+        self.sock = None
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+    def after_fork(self):
+        # the socket is shared with the parent: leave it to the parent and
+        # send on a connection of our own
+        self.pending = {}
+        self.sent = {}
+        self.sock = None
+        self.lock = threading.Lock()
+        if self.stop_event is not None:
+            self.start()
+
+    def connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else (
+            socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+            send_message(sock, HELLO)
+            with sock.makefile('rb') as file:
+                answer = read_message(file)
+        except (OSError, ValueError):
+            sock.close()
+            raise
+        if answer is None:
+            sock.close()
+            raise ConnectionError('The collector closed the connection')
+        if answer != [True, None]:
+            sock.close()
+            raise ValueError(
+                answer[1] if isinstance(answer, list) and len(answer) == 2
+                else 'not an OpTrace collector')
+        self.sock = sock
+        self.sent = {}
+
+    def refuse(self, reason):
+        # the same would happen over any new connection: stop sending
+        self.refused = reason
+        self.pending = {}
+        if self.hook.tracing:
+            self.hook.emit('refused', None, address=self.address,
+                           reason=reason)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def add_pending(self, snapshot):
+        for module, delta in snapshot.items():
+            pending = self.pending.setdefault(module, {})
+            for probe_id, hits in delta.items():
+                pending[probe_id] = pending.get(probe_id, 0) + hits
+
+    def make_message(self):
+        modules = []
+        for module, data in list(self.hook.module_opcodes.items()):
+            first = self.sent.get(module, 0)
+            pending = self.pending.get(module, {})
+            if first == len(data) and not pending:
+                continue
+            rows = [
+                (data.codeobj_ids[probe_id],) + data.get_row(probe_id)
+                for probe_id in range(first, len(data))
+            ]
+            modules.append((
+                module, None if module in self.sent else data.source,
+                first, rows, list(pending.keys()), list(pending.values()),
+            ))
+        return self.hook.mode == 'count', modules
+
+    def send(self):
+        with self.lock:
+            if self.refused is not None:
+                return False
+            self.add_pending(self.hook.take_snapshot())
+            try:
+                if self.sock is None:
+                    self.connect()
+                message = self.make_message()
+                if message[1]:
+                    send_message(self.sock, message)
+            except OSError:
+                # the collector may have read part of it: start over on a
+                # new connection, rows included
+                self.close()
+                return False
+            except ValueError as error:
+                self.refuse(str(error))
+                return False
+            for module, _, first, rows, _, _ in message[1]:
+                self.sent[module] = first + len(rows)
+            self.pending = {}
+            return True
+
+    def start(self):
+        stop = self.stop_event = threading.Event()
+        def send_loop():
+            while not stop.wait(self.interval):
+                self.send()
+        self.thread = threading.Thread(target=send_loop, name='OpTraceClient')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread and send what is left, never-called code too."""
+        if self.stop_event is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.stop_event = self.thread = None
+        for data in list(self.hook.module_opcodes.values()):
+            data.collect()
+        self.send()
+        self.close()
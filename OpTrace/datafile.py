@@ -0,0 +1,227 @@
+import binascii
+import hashlib
+import marshal
+import os
+import struct
+
+from array import array
+from importlib.util import decode_source, MAGIC_NUMBER
+from itertools import repeat
+
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+class DataFile:
+    """
+    Coverage of one process, written to <directory>/optrace-<pid>-<token>.data
+    so that another process or `python -m OpTrace` can combine it.
+
+    The file starts with MAGIC, the bytecode magic number of the Python that
+    wrote it and the size of the index, a marshalled list of (module,
+    digest, offset, sizes) entries, followed by one section per
+    entry: the marshalled metadata (source path and the instruction rows,
+    column by column), the visited flags packed one bit per row and, in
+    count mode, the counters. Entries with the same module and metadata
+    digest describe the same rows, so combine() merges them by OR-ing the
+    bitmaps without decoding the metadata at all.
+
+    Rows hold opcode numbers, which change from one Python version to the
+    next, so files written by another version are refused.
+    """
+    PREFIX = 'optrace-'
+    SUFFIX = '.data'
+    MAGIC = b'OPTRACE\x02'
+    HEADER = struct.Struct('<8s4sI')
+    FROM_ASCII = bytes.maketrans(b'01', b'\x00\x01')
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.name = None
+        self.new_name()
+
+    def new_name(self):
+        # pids are reused, the token keeps files of different runs apart
+        self.name = '{}{}-{}{}'.format(
+            self.PREFIX, os.getpid(),
+            binascii.hexlify(os.urandom(4)).decode(), self.SUFFIX)
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name)
+
+    @classmethod
+    def pack_bits(cls, flags):
+        return FileOpcode.to_bits(flags).to_bytes(
+            (len(flags) + 7) // 8, 'little')
+
+    @classmethod
+    def unpack_bits(cls, packed, size):
+        if not size:
+            return bytearray()
+        bits = int.from_bytes(packed, 'little')
+        return bytearray(format(bits, '0{}b'.format(size))[::-1].encode()
+                         .translate(cls.FROM_ASCII))
+
+    def encode(self, data):
+        codes = []
+        flags = bytearray()
+        counts = array('Q')
+        for codeobj_id, (start, stop) in sorted(data.code_rows.items()):
+            codes.append((
+                codeobj_id,
+                array('I', data.offsets[start:stop]).tobytes(),
+                data.ops[start:stop].tobytes(),
+                data.args[start:stop].tobytes(),
+                array('I', data.lines[start:stop]).tobytes(),
+                array('I', data.argreprs[start:stop]).tobytes(),
+                bytes(data.jump_targets[start:stop]),
+            ))
+            flags += data.visited[start:stop]
+            if data.counts is not None:
+                counts.extend(data.counts[start:stop])
+        # the source itself is only kept when there is no file to read it from
+        meta = (data.path, None if data.path else data.source, data.strings,
+                codes)
+        # marshal output depends on object identity, repr does not
+        digest = hashlib.sha1(repr(meta).encode()).digest()
+        return (
+            digest, marshal.dumps(meta), self.pack_bits(flags),
+            counts.tobytes(),
+        )
+
+    def decode(self, meta):
+        path, source, strings, codes = marshal.loads(meta)
+        rows = []
+        for codeobj_id, offsets, ops, args, lines, argreprs, jumps in codes:
+            columns = (
+                array('I', offsets), array('B', ops), array('q', args),
+                array('I', lines),
+                [strings[index] for index in array('I', argreprs)], jumps,
+            )
+            rows.extend((codeobj_id, row) for row in zip(*columns))
+        return path, source, rows
+
+    def write(self, path, entries):
+        index = []
+        sections = []
+        offset = 0
+        for module, digest, meta, bits, counts in entries:
+            index.append((
+                module, digest, offset,
+                len(meta), len(bits), len(counts),
+            ))
+            sections.extend((meta, bits, counts))
+            offset += len(meta) + len(bits) + len(counts)
+        blob = marshal.dumps(index)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, MAGIC_NUMBER, len(blob)))
+            file.write(blob)
+            for section in sections:
+                file.write(section)
+        os.replace(temp_path, path)
+
+    def read(self, path, known=()):
+        """
+        Yield (module, digest, meta, bits, counts) per entry; meta is None
+        for the (module, digest) pairs in `known`, which are not read.
+        """
+        with open(path, 'rb') as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size or not header.startswith(
+                    self.MAGIC):
+                raise ValueError('{} is not an OpTrace data file'.format(path))
+            _, python_magic, size = self.HEADER.unpack(header)
+            if python_magic != MAGIC_NUMBER:
+                raise ValueError(
+                    '{} was written by another Python version, its opcode '
+                    'numbers do not apply here'.format(path))
+            index = marshal.loads(file.read(size))
+            base = self.HEADER.size + size
+            for module, digest, offset, meta_size, bits_size, counts_size in index:
+                file.seek(base + offset)
+                if (module, digest) in known:
+                    meta = None
+                    file.seek(meta_size, os.SEEK_CUR)
+                else:
+                    meta = file.read(meta_size)
+                yield (
+                    module, digest, meta, file.read(bits_size),
+                    file.read(counts_size),
+                )
+
+    def dump(self, module_opcodes):
+        self.write(self.path, [
+            (module,) + self.encode(data)
+            for module, data in sorted(list(module_opcodes.items()))
+        ])
+
+    def iter_paths(self):
+        """Data files of the other processes."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return
+        for name in names:
+            if (name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)
+                    and name != self.name):
+                yield os.path.join(self.directory, name)
+
+    def combine(self, paths):
+        """Merge the entries of many files into one list for write()."""
+        merged = {}
+        order = []
+        for path in paths:
+            for module, digest, meta, bits, counts in self.read(path, merged):
+                key = module, digest
+                if key not in merged:
+                    merged[key] = [
+                        meta, int.from_bytes(bits, 'little'), len(bits),
+                        array('Q', counts),
+                    ]
+                    order.append(key)
+                    continue
+                entry = merged[key]
+                entry[1] |= int.from_bytes(bits, 'little')
+                if not counts:
+                    continue
+                if not entry[3]:
+                    entry[3] = array('Q', counts)
+                    continue
+                for row, count in enumerate(array('Q', counts)):
+                    entry[3][row] += count
+
+        entries = []
+        for module, digest in order:
+            meta, bits, size, counts = merged[module, digest]
+            entries.append((
+                module, digest, meta, bits.to_bytes(size, 'little'),
+                counts.tobytes(),
+            ))
+        return entries
+
+    def read_source(self, path):
+        with open(path, 'rb') as file:
+            return decode_source(file.read()).splitlines()
+
+    def merge(self, entries, module_opcodes):
+        """Add entries to FileOpcode objects, creating missing ones."""
+        for module, _, meta, bits, counts in entries:
+            path, source, rows = self.decode(meta)
+            data = module_opcodes.get(module)
+            if data is None:
+                if source is None:
+                    source = self.read_source(path)
+                data = module_opcodes[module] = FileOpcode(module, source)
+                data.path = path
+            flags = self.unpack_bits(bits, len(rows))
+            counts = array('Q', counts) if counts else repeat(0)
+            for (codeobj_id, row), hit, count in zip(rows, flags, counts):
+                data.merge_row(codeobj_id, row, hit, count)
+
+    def load(self, path, module_opcodes):
+        self.merge(self.read(path), module_opcodes)
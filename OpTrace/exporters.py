@@ -0,0 +1,223 @@
+import json
+import time
+
+from collections import OrderedDict
+from xml.sax.saxutils import quoteattr
+
+from OpTrace import __version__
+from OpTrace.reporter import FileReporter
+
+
+class Exporter:
+    """
+    Writes the coverage of every module to a file handle as it goes: only
+    the lines of the module being written are held in memory, whatever the
+    number of modules.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, *parts):
+        for part in parts:
+            self.file.write(part)
+
+    @staticmethod
+    def get_filename(data):
+        return data.path or '{}.py'.format(data.module.replace('.', '/'))
+
+    @staticmethod
+    def get_lines(data):
+        """Sorted (line, counts) pairs, one count per opcode of the line."""
+        data.collect()
+        lines = {}
+        line = None
+        for opcode in data.iter_opcodes():
+            if opcode.starts_line:
+                line = opcode.starts_line
+            if line is not None:
+                lines.setdefault(line, []).append(
+                    opcode.count if opcode.visited else 0)
+        return sorted(lines.items())
+
+    @staticmethod
+    def get_missing(data):
+        """Sorted ((line, opname), spans) of the opcodes that never ran."""
+        reporter = FileReporter(data)
+        reporter.analyze()
+        return [
+            (key, reporter.merge_spans(spans, len(data.source[key[0]])))
+            for key, spans in sorted(reporter.missing_positions.items())
+        ]
+
+    def export(self, module_opcodes):
+        self.begin()
+        for _, data in sorted(list(module_opcodes.items())):
+            self.add_module(data)
+        self.end()
+
+    def begin(self):
+        pass
+
+    def add_module(self, data):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+
+class JsonExporter(Exporter):
+    """
+    {"modules": [...]} with one object per module: `lines` lists
+    [line, opcodes, visited opcodes, hits] and `missing` the source spans
+    of the opcodes that never ran, [start, stop) columns on 1-based lines.
+    """
+
+    def begin(self):
+        self.separator = '\n'
+        self.write('{"version": ', json.dumps(__version__), ', "modules": [')
+
+    def add_module(self, data):
+        lines = [
+            [line, len(counts), len(counts) - counts.count(0), max(counts)]
+            for line, counts in self.get_lines(data)
+        ]
+        missing = [
+            OrderedDict([
+                ('line', line + 1), ('opname', opname), ('spans', spans),
+            ])
+            for (line, opname), spans in self.get_missing(data)
+        ]
+        self.write(self.separator, json.dumps(OrderedDict([
+            ('module', data.module),
+            ('filename', self.get_filename(data)),
+            ('lines', lines),
+            ('missing', missing),
+        ]), separators=(',', ':')))
+        self.separator = ',\n'
+
+    def end(self):
+        self.write('\n]}\n')
+
+
+class LcovExporter(Exporter):
+    """
+    LCOV tracefile. Every opcode of a line is a BRDA branch of it, so
+    tools that show branch coverage show opcode coverage.
+    """
+
+    def add_module(self, data):
+        lines = self.get_lines(data)
+        self.write('TN:\nSF:', self.get_filename(data), '\n')
+        branches = branches_hit = 0
+        for line, counts in lines:
+            # '-' is for branches whose line never ran, those of a line
+            # that ran were reached and not taken
+            ran = max(counts) > 0
+            for index, count in enumerate(counts):
+                self.write('BRDA:{},0,{},{}\n'.format(
+                    line, index, count if ran else '-'))
+            branches += len(counts)
+            branches_hit += len(counts) - counts.count(0)
+        self.write('BRF:{}\nBRH:{}\n'.format(branches, branches_hit))
+        for line, counts in lines:
+            self.write('DA:{},{}\n'.format(line, max(counts)))
+        self.write('LF:{}\nLH:{}\nend_of_record\n'.format(
+            len(lines), sum(1 for _, counts in lines if max(counts))))
+
+
+class CoberturaExporter(Exporter):
+    """
+    Cobertura XML, one package per parent package and one class per
+    module; opcodes are reported as the conditions of their line. The
+    rates of the root and package elements come first in the file, so the
+    totals are counted in a first pass that keeps nothing but the numbers.
+    """
+
+    @staticmethod
+    def get_package(module):
+        return module.rpartition('.')[0]
+
+    @staticmethod
+    def get_totals(lines):
+        opcodes = [count for _, counts in lines for count in counts]
+        return [
+            len(lines), sum(1 for _, counts in lines if max(counts)),
+            len(opcodes), len(opcodes) - opcodes.count(0),
+        ]
+
+    @staticmethod
+    def get_rates(totals):
+        lines, lines_hit, branches, branches_hit = totals
+        return (
+            '{:.4f}'.format(lines_hit / lines if lines else 1),
+            '{:.4f}'.format(branches_hit / branches if branches else 1),
+        )
+
+    def export(self, module_opcodes):
+        # each package has to be contiguous
+        modules = sorted(
+            list(module_opcodes.items()),
+            key=lambda item: (self.get_package(item[0]), item[0]))
+        packages = OrderedDict()
+        for module, data in modules:
+            totals = packages.setdefault(self.get_package(module), [0] * 4)
+            counted = self.get_totals(self.get_lines(data))
+            for index, value in enumerate(counted):
+                totals[index] += value
+
+        totals = [sum(column) for column in zip(*packages.values())] or [0] * 4
+        line_rate, branch_rate = self.get_rates(totals)
+        self.write(
+            '<?xml version="1.0" ?>\n',
+            '<coverage version={} timestamp="{}" lines-valid="{}" '
+            'lines-covered="{}" branches-valid="{}" branches-covered="{}" '
+            'line-rate="{}" branch-rate="{}" complexity="0">\n'.format(
+                quoteattr(__version__), int(time.time() * 1000),
+                totals[0], totals[1], totals[2], totals[3],
+                line_rate, branch_rate),
+            '<sources><source>.</source></sources>\n<packages>\n',
+        )
+        package = None
+        for module, data in modules:
+            if self.get_package(module) != package:
+                if package is not None:
+                    self.write('</classes></package>\n')
+                package = self.get_package(module)
+                line_rate, branch_rate = self.get_rates(packages[package])
+                self.write(
+                    '<package name={} line-rate="{}" branch-rate="{}" '
+                    'complexity="0"><classes>\n'.format(
+                        quoteattr(package), line_rate, branch_rate))
+            self.add_module(data)
+        if package is not None:
+            self.write('</classes></package>\n')
+        self.write('</packages>\n</coverage>\n')
+
+    def add_module(self, data):
+        lines = self.get_lines(data)
+        line_rate, branch_rate = self.get_rates(self.get_totals(lines))
+        self.write(
+            '<class name={} filename={} line-rate="{}" branch-rate="{}" '
+            'complexity="0"><methods/><lines>\n'.format(
+                quoteattr(data.module), quoteattr(self.get_filename(data)),
+                line_rate, branch_rate))
+        for line, counts in lines:
+            hit = len(counts) - counts.count(0)
+            if len(counts) > 1:
+                self.write(
+                    '<line number="{}" hits="{}" branch="true" '
+                    'condition-coverage="{}% ({}/{})"/>\n'.format(
+                        line, max(counts), 100 * hit // len(counts), hit,
+                        len(counts)))
+            else:
+                self.write('<line number="{}" hits="{}" branch="false"/>\n'
+                           .format(line, max(counts)))
+        self.write('</lines></class>\n')
+
+
+EXPORTERS = OrderedDict([
+    ('json', JsonExporter),
+    ('lcov', LcovExporter),
+    ('cobertura', CoberturaExporter),
+])
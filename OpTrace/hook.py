@@ -1,10 +1,26 @@
+import atexit
+import gc
+import os
 import sys
+import threading
+import weakref
 
+from collections import OrderedDict
+from multiprocessing.util import Finalize, register_after_fork
+from types import CodeType, FunctionType
 from importlib.machinery import SourceFileLoader
 from importlib.abc import MetaPathFinder
+from importlib.util import decode_source
 
-from OpTrace.wrapper import Wrapper
-from OpTrace.reporter import CommonReporter
+from OpTrace.cache import CodeCache
+from OpTrace.collector import CollectorClient
+from OpTrace.datafile import DataFile
+from OpTrace.exporters import EXPORTERS
+from OpTrace.matcher import ModuleMatcher
+from OpTrace.monitoring import MonitoringEngine, MonitoringWrapper, monitoring
+from OpTrace.walker import iter_functions
+from OpTrace.wrapper import Wrapper, LazyWrapper
+from OpTrace.reporter import CommonReporter, HotReporter
 from OpTrace.wrapped_opcode import FileOpcode
 
 
@@ -19,69 +35,648 @@ assert _REAL_PATHFINDER is not None, 'Original PathFinder not found.'
 _PATHFINDER_INDEX = sys.meta_path.index(_REAL_PATHFINDER)
 
 
+class OpTraceLoader(SourceFileLoader):
+    """Source loader of the target modules, shared by every hook."""
+
+    def __init__(self, hook, fullname, path):
+        super().__init__(fullname, path)
+        self.hook = hook
+
+    def get_code(self, fullname):
+        code = super().get_code(fullname)
+        return self.hook.get_code(self, fullname, code)
+
+
+class OpTraceFinder(MetaPathFinder):
+    """
+    Stands in for PathFinder while a hook is set up. Specs of other modules
+    are returned untouched; target modules found as source files get an
+    OpTraceLoader.
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+
+    def find_spec(self, fullname, path=None, target=None):
+        if self.hook.tracing:
+            self.hook.emit('find', fullname)
+        spec = _REAL_PATHFINDER.find_spec(fullname, path, target)
+        if (spec is not None and fullname in self.hook.target_modules
+                and isinstance(spec.loader, SourceFileLoader)):
+            spec.loader = OpTraceLoader(self.hook, fullname, spec.origin)
+        return spec
+
+    def invalidate_caches(self):
+        _REAL_PATHFINDER.invalidate_caches()
+
+
 class OpTraceHook:
-    def __init__(self, modules, debug=False):
-        self.target_modules = modules
+    MODES = ('trace', 'probe', 'count')
+    ENGINES = ('rewrite', 'monitoring')
+
+    def __init__(self, modules, debug=False, mode='trace',
+                 granularity='opcode', retire_interval=None, cache=False,
+                 lazy=False, debug_sink=None, thread_buffers=False,
+                 data_dir=None, sample_ratio=None, sample_window=1.0,
+                 collector=None, collect_interval=1.0, engine='rewrite',
+                 snapshots=False):
+        if mode not in self.MODES:
+            raise ValueError('Unknown mode {!r}, expected one of {}'.format(
+                mode, ', '.join(self.MODES)))
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown engine {!r}, expected one of {}'.format(
+                engine, ', '.join(self.ENGINES)))
+        if engine == 'monitoring':
+            if monitoring is None:
+                raise ValueError("engine='monitoring' requires Python 3.12+")
+            if (lazy or cache or thread_buffers or sample_ratio is not None
+                    or retire_interval is not None):
+                # all of them work on rewritten code objects
+                raise ValueError(
+                    "engine='monitoring' cannot be combined with lazy, "
+                    "cache, thread_buffers, sample_ratio or retire_interval")
+        if granularity not in Wrapper.GRANULARITIES:
+            raise ValueError('Unknown granularity {!r}, expected one of {}'.format(
+                granularity, ', '.join(Wrapper.GRANULARITIES)))
+        if cache and mode == 'trace':
+            # trace callbacks are closures and cannot be marshalled
+            raise ValueError("cache requires mode='probe' or mode='count'")
+        if cache and thread_buffers:
+            # the probes load the thread buffers object, a live object
+            raise ValueError('cache cannot be combined with thread_buffers')
+        if cache and lazy:
+            # lazy stubs call back into the wrapper and cannot be marshalled
+            raise ValueError('cache cannot be combined with lazy')
+        if mode == 'count' and retire_interval is not None:
+            # retired code counts nothing, so the counts would come out low
+            raise ValueError("retire_interval cannot be combined with "
+                             "mode='count'")
+        if snapshots and collector is not None:
+            # the client takes the snapshots, and each would steal the
+            # other's hits
+            raise ValueError('snapshots cannot be combined with collector')
+        if sample_ratio is not None:
+            if not 0 < sample_ratio <= 1:
+                raise ValueError('sample_ratio must be in (0, 1]')
+            if lazy or retire_interval is not None:
+                # both swap code objects on their own schedule
+                raise ValueError(
+                    'sample_ratio cannot be combined with lazy or '
+                    'retire_interval')
+        self.target_modules = ModuleMatcher(modules)
         self.module_opcodes = dict()
         self.debug = debug
+        self.debug_sink = debug_sink
+        self.mode = mode
+        self.granularity = granularity
+        self.engine = engine
+        self.monitor = None
+        if engine == 'monitoring':
+            self.monitor = MonitoringEngine(granularity, mode == 'count')
+        self.retire_interval = retire_interval
+        self.retire_stop = None
+        self.sample_ratio = sample_ratio
+        self.sample_window = sample_window
+        self.sample_stop = None
+        # functions of the target modules, found by find_sampled
+        self.sampled = weakref.WeakSet()
+        # dirty flags cost a store per frame start, only pay it for readers
+        self.snapshots = snapshots or collector is not None
+        self.cache = CodeCache(
+            mode, granularity, self.snapshots) if cache else None
+        self.lazy = lazy
+        self.thread_buffers = thread_buffers
+        self.data_file = DataFile(data_dir) if data_dir is not None else None
+        self.data_pid = None
+        self.fork_pid = None
+        self.combined = set()
+        self.collector = collector
+        self.collect_interval = collect_interval
+        self.client = None
+        # module name -> [(function, code before attach)]
+        self.attached = {}
+        # context -> {module: bitset of the probe ids it ran}
+        self.context = None
+        self.contexts = OrderedDict()
+
+    @property
+    def tracing(self):
+        return self.debug or self.debug_sink is not None
 
     def log(self, *args):
         if self.debug:
             print(*args)
 
+    def emit(self, event, module, **fields):
+        """Hand a debug event to debug_sink and print it in debug mode."""
+        if self.debug_sink is not None:
+            self.debug_sink(event, module, fields)
+        if self.debug:
+            self.log(' {} {} {}'.format(event, module, ' '.join(
+                '{}={!r}'.format(key, value)
+                for key, value in sorted(fields.items())
+            )))
+
+    # The make_* callbacks below are bound to the FileOpcode of the module
+    # when they are built; without debugging they do no more than the
+    # FileOpcode call itself.
+
     def make_marker(self, module, source):
-        self.module_opcodes[module] = FileOpcode(module, source)
+        data = self.module_opcodes[module] = FileOpcode(
+            module, source, self.thread_buffers, self.granularity)
+        add = data.add
+        if not self.tracing:
+            def mark(codeobj_id, opcode):
+                return add(codeobj_id, opcode.offset, opcode)
+            return mark
+
         def mark(codeobj_id, opcode):
-            self.module_opcodes[module].add(codeobj_id, opcode.offset, opcode)
-            self.log(
-                ' mark {}_{} {}'.format(codeobj_id, opcode.offset, repr(opcode)))
+            probe_id = add(codeobj_id, opcode.offset, opcode)
+            self.emit(
+                'mark', module, codeobj_id=codeobj_id, offset=opcode.offset,
+                probe_id=probe_id, opname=opcode.opname)
+            return probe_id
         return mark
 
     def make_visitor(self, module):
-        def visit(codeobj_id, opcode):
-            self.module_opcodes[module].visit(codeobj_id, opcode.offset, opcode)
-            self.log(' visit {}_{} {}'.format(
-                codeobj_id, opcode.offset, repr(opcode)))
+        data = self.module_opcodes[module]
+        if data.buffers is not None:
+            return self.make_buffered_visitor(module, data)
+
+        visited = data.visited
+        if not self.tracing:
+            def visit(probe_id):
+                visited[probe_id] = 1
+            return visit
+
+        def visit(probe_id):
+            visited[probe_id] = 1
+            self.emit('visit', module, probe_id=probe_id)
         return visit
 
-    def report(self):
-        reporter = CommonReporter(self.module_opcodes)
+    def make_buffered_visitor(self, module, data):
+        buffers = data.buffers
+        def visit(probe_id):
+            visited = buffers.visited
+            try:
+                visited[probe_id] = 1
+            except IndexError:
+                # rows marked after this thread's buffer was made
+                visited.extend(bytes(len(data) - len(visited)))
+                visited[probe_id] = 1
+        if not self.tracing:
+            return visit
+
+        def traced_visit(probe_id):
+            visit(probe_id)
+            self.emit('visit', module, probe_id=probe_id)
+        return traced_visit
+
+    def make_hits(self, module):
+        if self.mode == 'trace':
+            return None
+        add_hits = self.module_opcodes[module].add_hits
+        if not self.tracing:
+            return add_hits
+
+        def traced_add_hits(codeobj_id, hits, bounds):
+            add_hits(codeobj_id, hits, bounds)
+            self.emit('hits', module, codeobj_id=codeobj_id, size=len(hits))
+        return traced_add_hits
+
+    def make_code_register(self, module):
+        return self.module_opcodes[module].add_code
+
+    def make_pending(self, module):
+        add_pending = self.module_opcodes[module].add_pending
+        if not self.tracing:
+            return add_pending
+
+        def traced_add_pending(codeobj_id, original, stub):
+            add_pending(codeobj_id, original, stub)
+            self.emit(
+                'pending', module, codeobj_id=codeobj_id,
+                name=original.co_name)
+        return traced_add_pending
+
+    def restore_code(self, data, codeobj_id):
+        # Original bytecode, but nested code objects keep whatever variant is
+        # current, so functions created later are still traced until they
+        # are complete themselves.
+        original, _ = data.codes[codeobj_id]
+        return Wrapper.copy_code(original, co_consts=tuple(
+            data.current_code(item) if isinstance(item, CodeType) else item
+            for item in original.co_consts
+        ))
+
+    def retire_probes(self):
+        """
+        Swap fully visited functions back to their uninstrumented code.
+        Coverage stays exact: nothing in those code objects is left to see.
+        Counts would not, so count mode does not retire.
+        """
+        if self.mode == 'count':
+            raise ValueError("retire_probes cannot be used with mode='count'")
+        swaps = {}
+        for data in list(self.module_opcodes.values()):
+            retired = []
+            # nested code objects have bigger ids, retire them first
+            for codeobj_id in sorted(data.completed(), reverse=True):
+                if codeobj_id in data.retired:
+                    continue
+                data.retired[codeobj_id] = self.restore_code(data, codeobj_id)
+                retired.append(codeobj_id)
+                if self.tracing:
+                    self.emit('retire', data.module, codeobj_id=codeobj_id)
+
+            # A parent function that still runs instrumented keeps creating
+            # instrumented closures, so those are looked up on every pass.
+            # Module level code runs once and needs no second look.
+            for codeobj_id in list(data.retired):
+                parent = data.parents.get(codeobj_id, 0)
+                if codeobj_id in retired or (
+                        parent and parent not in data.retired):
+                    _, instrumented = data.codes[codeobj_id]
+                    swaps[id(instrumented)] = (
+                        instrumented, data.retired[codeobj_id])
+
+        self.swap_functions(swaps)
+
+    @staticmethod
+    def swap_functions(swaps, functions=None):
+        """
+        Point every function running one of the code objects in swaps,
+        id(code) -> (code, replacement), at the replacement. Only functions
+        are looked at if given, otherwise every object on the heap.
+        """
+        if not swaps:
+            return
+        if functions is None:
+            functions = gc.get_referrers(
+                *(code for code, _ in swaps.values()))
+        for referrer in functions:
+            if not isinstance(referrer, FunctionType):
+                continue
+            swap = swaps.get(id(referrer.__code__))
+            if swap is not None and referrer.__code__ is swap[0]:
+                referrer.__code__ = swap[1]
+
+    def start_retiring(self):
+        stop = self.retire_stop = threading.Event()
+        def retire_loop():
+            while not stop.wait(self.retire_interval):
+                self.retire_probes()
+        thread = threading.Thread(target=retire_loop, name='OpTraceRetire')
+        thread.daemon = True
+        thread.start()
+
+    def sample(self, instrumented):
+        """
+        Switch every function to its instrumented or its original code.
+        The hit maps are left alone, so coverage adds up across windows.
+        """
+        swaps = {}
+        for data in list(self.module_opcodes.values()):
+            for old, code in list(data.codes.values()):
+                if not instrumented:
+                    old, code = code, old
+                swaps[id(old)] = old, code
+            if self.tracing:
+                self.emit('sample', data.module, instrumented=instrumented)
+        self.find_sampled()
+        self.swap_functions(swaps, list(self.sampled))
+
+    def find_sampled(self):
+        """
+        Add the functions reachable from the target modules to sampled.
+        That walks their namespaces, not the heap, so a window edge costs
+        what the targets define. Closures only other frames hold keep the
+        code of the window they were created in.
+        """
+        for data in list(self.module_opcodes.values()):
+            module = sys.modules.get(data.module)
+            if module is None:
+                continue
+            for function in iter_functions(vars(module), closures=True):
+                self.sampled.add(function)
+
+    def start_sampling(self):
+        # instrumented for sample_ratio of every sample_window seconds
+        stop = self.sample_stop = threading.Event()
+        on = self.sample_window * self.sample_ratio
+        off = self.sample_window - on
+        def sample_loop():
+            while True:
+                self.sample(True)
+                if stop.wait(on):
+                    break
+                self.sample(False)
+                if stop.wait(off):
+                    return
+            self.sample(False)
+        thread = threading.Thread(target=sample_loop, name='OpTraceSample')
+        thread.daemon = True
+        thread.start()
+
+    def attach(self, module):
+        """
+        Instrument an already imported module in place: its source is
+        compiled again and every function reachable from the module whose
+        code matches a compiled code object gets the instrumented one.
+        """
+        if self.lazy:
+            raise ValueError('attach cannot be combined with lazy')
+        name = module.__name__
+        if name in self.attached:
+            return
+        if name not in self.module_opcodes:
+            path = getattr(module, '__file__', None)
+            if not path or not path.endswith('.py'):
+                raise ValueError('{} has no Python source'.format(name))
+            with open(path, 'rb') as file:
+                source_bytes = file.read()
+            # compiled like the import system does, so that unchanged
+            # functions compare equal to their code objects
+            code = compile(source_bytes, path, 'exec', dont_inherit=True)
+            wrapper = self.make_wrapper(
+                name, decode_source(source_bytes).splitlines())
+            self.module_opcodes[name].path = path
+            wrapper.wrap_code(code)
+            del wrapper
+
+        # code objects compare by value, not identity
+        codes = dict(self.module_opcodes[name].codes.values())
+        functions = []
+        for function in iter_functions(vars(module), closures=True):
+            instrumented = codes.get(function.__code__)
+            if instrumented is not None:
+                functions.append((function, function.__code__))
+                function.__code__ = instrumented
+        self.attached[name] = functions
+        if self.tracing:
+            self.emit('attach', name, functions=len(functions))
+
+    def detach(self, module=None):
+        """
+        Give the functions of module (of every attached module by default)
+        their code from before attach. The coverage recorded stays.
+        """
+        names = list(self.attached)
+        if module is not None:
+            names = [name for name in names if name == module.__name__]
+        swaps = {}
+        for name in names:
+            for function, code in self.attached.pop(name):
+                function.__code__ = code
+            # closures made by instrumented code since attach
+            codes = self.module_opcodes[name].codes
+            for original, instrumented in codes.values():
+                swaps[id(instrumented)] = instrumented, original
+            if self.tracing:
+                self.emit('detach', name)
+        self.swap_functions(swaps)
+
+    def set_context(self, context):
+        """
+        Attribute what ran since the previous call to the previous context,
+        then record for context (a test id, say; None records for none).
+        """
+        if self.mode == 'trace' or self.retire_interval is not None:
+            # trace probes write straight to visited, retired code records
+            # nothing: neither can tell contexts apart
+            raise ValueError(
+                "contexts require mode='probe' or mode='count' and no "
+                "retire_interval")
+        for module, data in list(self.module_opcodes.items()):
+            bits = data.drain()
+            if self.context is None or not bits:
+                continue
+            modules = self.contexts.setdefault(self.context, {})
+            modules[module] = modules.get(module, 0) | bits
+        self.context = context
+        if self.monitor is not None:
+            # what ran for the previous context has to fire again
+            self.monitor.restart()
+
+    def get_contexts(self, module, lines=(), codeobj_ids=()):
+        """
+        Contexts that ran any opcode of module on the given (1-based) lines
+        or in the given code objects, in the order they were first set.
+        """
+        self.set_context(self.context)
+        data = self.module_opcodes.get(module)
+        if data is None:
+            return []
+        probes = data.get_probe_bits(lines, codeobj_ids)
+        return [
+            context for context, modules in self.contexts.items()
+            if modules.get(module, 0) & probes
+        ]
+
+    def snapshot(self):
+        """
+        Hits recorded since the previous snapshot, as {module: {probe_id:
+        hits}}, while the hook stays set up. Only the code objects that ran
+        since are read, so the cost follows what changed.
+        """
+        if self.collector is not None:
+            raise ValueError(
+                'the collector client takes the snapshots of this hook')
+        if not self.snapshots:
+            raise ValueError('snapshot requires snapshots=True')
+        return self.take_snapshot()
+
+    def take_snapshot(self):
+        # snapshot() without the checks, for the collector client
+        taken = [
+            (module, data, data.take_dirty())
+            for module, data in list(self.module_opcodes.items())
+        ]
+        # after taking the flags: a frame that started before and is still
+        # running now would not set its flag again
+        running = set()
+        for frame in list(sys._current_frames().values()):
+            while frame is not None:
+                running.add(id(frame.f_code))
+                frame = frame.f_back
+        snapshot = {}
+        for module, data, codeobj_ids in taken:
+            data.keep_dirty(running)
+            delta = data.snapshot(codeobj_ids)
+            if delta:
+                snapshot[module] = delta
+        return snapshot
+
+    def flush(self):
+        """Write the coverage of this process to its data file."""
+        if self.data_file is None:
+            return
+        for data in list(self.module_opcodes.values()):
+            data.collect()
+        self.data_file.dump(self.module_opcodes)
+        if self.tracing:
+            self.emit('flush', None, path=self.data_file.path)
+
+    def combine(self):
+        """OR the data files other processes wrote into this coverage."""
+        if self.data_file is None:
+            return
+        for data in list(self.module_opcodes.values()):
+            data.collect()
+        for path in self.data_file.iter_paths():
+            if path in self.combined:
+                continue
+            self.data_file.load(path, self.module_opcodes)
+            self.combined.add(path)
+            if self.tracing:
+                self.emit('combine', None, path=path)
+
+    def after_fork(self):
+        # runs in the child: what it inherited was recorded by the parent
+        if self.fork_pid == os.getpid():
+            return
+        self.fork_pid = os.getpid()
+        if self.data_pid is not None:
+            self.data_pid = os.getpid()
+            self.data_file.new_name()
+            self.combined = set()
+        if self.data_pid is not None or self.client is not None:
+            # the parent writes or sends these hits itself
+            for data in list(self.module_opcodes.values()):
+                data.reset()
+            if self.monitor is not None:
+                self.monitor.restart()
+        if self.retire_stop is not None:
+            self.start_retiring()
+        if self.sample_stop is not None:
+            self.start_sampling()
+        if self.client is not None:
+            self.client.after_fork()
+
+    def after_process_fork(self):
+        self.after_fork()
+        # multiprocessing children drop the finalizers they inherited and
+        # leave through os._exit, which skips atexit
+        if self.data_pid is not None:
+            Finalize(None, self.flush, exitpriority=100)
+        if self.client is not None:
+            Finalize(None, self.stop_client, exitpriority=100)
+
+    def watch_forks(self):
+        if self.fork_pid is not None:
+            return
+        self.fork_pid = os.getpid()
+        # Python 3.7+; without it plain os.fork() children keep the
+        # parent's hits, which only matters for counters
+        register_at_fork = getattr(os, 'register_at_fork', None)
+        if register_at_fork is not None:
+            register_at_fork(after_in_child=self.after_fork)
+        register_after_fork(self, OpTraceHook.after_process_fork)
+
+    def start_data_file(self):
+        if self.data_pid is not None:
+            return
+        self.data_pid = os.getpid()
+        atexit.register(self.flush)
+        self.watch_forks()
+
+    def start_client(self):
+        if self.client is None:
+            self.client = CollectorClient(
+                self, self.collector, self.collect_interval)
+            atexit.register(self.stop_client)
+            self.watch_forks()
+        self.client.start()
+
+    def stop_client(self):
+        if self.client is not None:
+            self.client.stop()
+
+    def report(self, workers=None):
+        self.combine()
+        reporter = CommonReporter(self.module_opcodes, workers)
+        reporter.report()
+
+    def report_hot(self, top=20):
+        self.combine()
+        reporter = HotReporter(self.module_opcodes, top)
         reporter.report()
 
-    def make_loader(self):
-        class OpTraceLoader(SourceFileLoader):
-            def get_code(_, module_name):
-                code = super().get_code(module_name)
-                if module_name in self.target_modules:
-                    source = super().get_source(module_name).splitlines()
-                    wrapper = Wrapper(
-                        trace_func=self.make_visitor(module_name),
-                        mark_func=self.make_marker(module_name, source)
-                    )
-                    new_code = wrapper.wrap_code(code)
-                    del wrapper
-                    return new_code
-                return code
-        return OpTraceLoader
-
-    def make_finder(self):
-        class OpTraceFinder(MetaPathFinder):
-            @classmethod
-            def find_module(cls, fullname, path=None):
-                self.log('find module ', fullname)
-                spec = _REAL_PATHFINDER.find_spec(fullname, path)
-                if not spec:
-                    if not hasattr(self, 'find_spec'):
-                        return
-                    found = self.find_spec(fullname, path)
-                    return found.loader if found is not None else None
-                loader = spec.loader
-                loader.__class__ = self.make_loader()
-                return loader
-        return OpTraceFinder
+    def export(self, file, format='json'):
+        """Write the coverage as json, lcov or cobertura to a file handle."""
+        self.combine()
+        EXPORTERS[format](file).export(self.module_opcodes)
+
+    def make_wrapper(self, module_name, source):
+        """The wrapper that instruments module_name, with a new FileOpcode."""
+        # the marker creates the FileOpcode the rest is bound to
+        mark_func = self.make_marker(module_name, source)
+        data = self.module_opcodes[module_name]
+        options = dict(
+            trace_func=self.make_visitor(module_name),
+            mark_func=mark_func,
+            hits_func=self.make_hits(module_name),
+            granularity=self.granularity,
+            code_func=self.make_code_register(module_name),
+            counters=self.mode == 'count',
+            buffers=data.buffers,
+            dirty=data.dirty if self.snapshots else None,
+        )
+        if self.monitor is not None:
+            return MonitoringWrapper(engine=self.monitor, **options)
+        if self.lazy:
+            # stays alive through the stubs it puts in co_consts
+            return LazyWrapper(
+                pending_func=self.make_pending(module_name), **options)
+        return Wrapper(**options)
+
+    def get_code(self, loader, module_name, code):
+        """Instrumented code of a target module, or code if it is not one."""
+        if module_name not in self.target_modules:
+            return code
+        path = loader.get_filename(module_name)
+        source_bytes = loader.get_data(path)
+        source = decode_source(source_bytes).splitlines()
+        if self.cache is not None:
+            data = FileOpcode(module_name, source)
+            data.path = path
+            new_code = self.cache.load(path, source_bytes, data, code)
+            if new_code is not None:
+                if self.tracing:
+                    self.emit('cached', module_name, path=path)
+                self.module_opcodes[module_name] = data
+                return new_code
+
+        wrapper = self.make_wrapper(module_name, source)
+        self.module_opcodes[module_name].path = path
+        new_code = wrapper.wrap_code(code)
+        del wrapper
+        if self.cache is not None:
+            self.cache.dump(
+                path, source_bytes, self.module_opcodes[module_name], new_code)
+        return new_code
 
     def setup_hook(self):
-        sys.meta_path[_PATHFINDER_INDEX] = self.make_finder()
+        sys.meta_path[_PATHFINDER_INDEX] = OpTraceFinder(self)
+        if self.monitor is not None:
+            self.monitor.start()
+        if self.retire_interval is not None:
+            self.start_retiring()
+        if self.sample_ratio is not None:
+            self.start_sampling()
+        if self.data_file is not None:
+            self.start_data_file()
+        if self.collector is not None:
+            self.start_client()
 
     def teardown_hook(self):
         sys.meta_path[_PATHFINDER_INDEX] = _REAL_PATHFINDER
+        if self.retire_stop is not None:
+            self.retire_stop.set()
+            self.retire_stop = None
+        if self.sample_stop is not None:
+            self.sample_stop.set()
+            self.sample_stop = None
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.stop_client()
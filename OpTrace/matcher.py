@@ -0,0 +1,98 @@
+import re
+
+from fnmatch import translate
+
+
+class ModuleMatcher:
+    """
+    Set of module names given as patterns:
+
+        'pkg.mod'        that module
+        'pkg.*'          every module below pkg, at any depth
+        'pkg.test_*'     fnmatch globs, one dotted segment each
+        '!pkg.vendor.*'  exclusions, which win over any inclusion
+
+    Patterns are split on dots into a trie, so `name in matcher` walks one
+    node per segment of the name instead of testing every pattern.
+    """
+    INCLUDE_MODULE = 1
+    EXCLUDE_MODULE = 2
+    INCLUDE_TREE = 4
+    EXCLUDE_TREE = 8
+    GLOB = re.compile(r'[*?[]')
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        self.root = MatcherNode()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __repr__(self):
+        return 'ModuleMatcher({!r})'.format(self.patterns)
+
+    def add(self, pattern):
+        exclude = pattern.startswith('!')
+        segments = pattern[1:].split('.') if exclude else pattern.split('.')
+        if not all(segments):
+            raise ValueError('Invalid module pattern {!r}'.format(pattern))
+        if segments[-1] == '*':
+            segments.pop()
+            flag = self.EXCLUDE_TREE if exclude else self.INCLUDE_TREE
+        else:
+            flag = self.EXCLUDE_MODULE if exclude else self.INCLUDE_MODULE
+
+        node = self.root
+        for segment in segments:
+            node = node.get_child(segment, bool(self.GLOB.search(segment)))
+        node.flags |= flag
+        self.patterns.append(pattern)
+
+    def __contains__(self, name):
+        nodes = [self.root]
+        included = False
+        for segment in name.split('.'):
+            # tree rules of the nodes reached so far cover this segment
+            for node in nodes:
+                if node.flags & self.EXCLUDE_TREE:
+                    return False
+                if node.flags & self.INCLUDE_TREE:
+                    included = True
+            nodes = [child for node in nodes for child in node.step(segment)]
+            if not nodes:
+                return included
+        for node in nodes:
+            if node.flags & self.EXCLUDE_MODULE:
+                return False
+            if node.flags & self.INCLUDE_MODULE:
+                included = True
+        return included
+
+
+class MatcherNode:
+    """One dotted segment of the patterns of a ModuleMatcher."""
+
+    __slots__ = ('children', 'globs', 'flags')
+
+    def __init__(self):
+        self.children = {}
+        self.globs = []
+        self.flags = 0
+
+    def get_child(self, segment, glob=False):
+        if not glob:
+            return self.children.setdefault(segment, MatcherNode())
+        for pattern, _, child in self.globs:
+            if pattern == segment:
+                return child
+        child = MatcherNode()
+        match = re.compile(translate(segment)).match
+        self.globs.append((segment, match, child))
+        return child
+
+    def step(self, segment):
+        child = self.children.get(segment)
+        if child is not None:
+            yield child
+        for _, match, child in self.globs:
+            if match(segment):
+                yield child
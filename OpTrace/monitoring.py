@@ -0,0 +1,263 @@
+import sys
+
+from types import CodeType
+
+from OpTrace.wrapper import Wrapper
+
+
+# Python 3.12+
+monitoring = getattr(sys, 'monitoring', None)
+
+
+class CodeProbes:
+    """
+    Slots of one watched code object. `hits` is the hit map the FileOpcode
+    reads, or a private one in trace mode where `visit` gets the probe ids
+    of a slot instead.
+    """
+
+    __slots__ = (
+        'code', 'codeobj_id', 'hits', 'counters', 'dirty', 'probe_ids',
+        'visit', 'offsets', 'lines', 'outcomes', 'events',
+    )
+
+    def __init__(self, code, codeobj_id, hits, counters, dirty, probe_ids,
+                 visit):
+        self.code = code
+        self.codeobj_id = codeobj_id
+        self.hits = hits
+        self.counters = counters
+        self.dirty = dirty
+        self.probe_ids = probe_ids
+        self.visit = visit
+        # offset -> slot, line -> slots, branch offset -> its outcome slots
+        self.offsets = {}
+        self.lines = {}
+        self.outcomes = {}
+        # the local events of the code object
+        self.events = 0
+
+    def hit(self, slot):
+        if self.dirty is not None:
+            self.dirty[self.codeobj_id] = 1
+        if self.counters:
+            self.hits[slot] += 1
+        else:
+            self.hits[slot] = 1
+        if self.visit is not None:
+            for probe_id in self.probe_ids[slot]:
+                self.visit(probe_id)
+
+
+class MonitoringEngine:
+    """
+    Records through sys.monitoring events instead of rewritten bytecode.
+    One tool serves every module of a hook; only the registered code
+    objects get (local) events, so other code runs without any. Events
+    are INSTRUCTION for the opcode and block granularities, LINE for line
+    and BRANCH and JUMP for branch. A callback marks the slot of its
+    location and returns DISABLE, so every location costs one call. In
+    count mode the events stay enabled and count every execution.
+    """
+    NAME = 'OpTrace'
+
+    def __init__(self, granularity, counters=False):
+        if monitoring is None:
+            raise RuntimeError('sys.monitoring requires Python 3.12+')
+        self.granularity = granularity
+        self.counters = counters
+        self.tool_id = None
+        # id(code) -> CodeProbes, which keeps the code alive
+        self.codes = {}
+
+        events = monitoring.events
+        # 3.14+ reports the two outcomes of a branch as events of their
+        # own, so each can be disabled once seen
+        self.split_branches = hasattr(events, 'BRANCH_LEFT')
+        # 3.13 has no LINE event for the line a code object starts on
+        # unless PY_START is watched too; see add()
+        self.watch_start = (
+            granularity == 'line' and sys.version_info >= (3, 13))
+        if granularity == 'line':
+            self.callbacks = {events.LINE: self.on_line}
+            if self.watch_start:
+                self.callbacks[events.PY_START] = self.on_start
+        elif granularity == 'branch':
+            self.callbacks = {events.JUMP: self.on_jump}
+            if self.split_branches:
+                self.callbacks[events.BRANCH_LEFT] = self.on_jump
+                self.callbacks[events.BRANCH_RIGHT] = self.on_jump
+            else:
+                self.callbacks[events.BRANCH] = self.on_branch
+        else:
+            self.callbacks = {events.INSTRUCTION: self.on_instruction}
+        self.events = 0
+        for event in self.callbacks:
+            self.events |= event
+
+    @staticmethod
+    def get_free_tool_id():
+        tool_ids = [monitoring.COVERAGE_ID] + list(range(6))
+        for tool_id in tool_ids:
+            if monitoring.get_tool(tool_id) is None:
+                return tool_id
+        raise RuntimeError('No free sys.monitoring tool id')
+
+    def start(self):
+        if self.tool_id is not None:
+            return
+        tool_id = self.get_free_tool_id()
+        monitoring.use_tool_id(tool_id, self.NAME)
+        self.tool_id = tool_id
+        for event, callback in self.callbacks.items():
+            monitoring.register_callback(tool_id, event, callback)
+        for probes in list(self.codes.values()):
+            monitoring.set_local_events(tool_id, probes.code, probes.events)
+
+    def stop(self):
+        if self.tool_id is None:
+            return
+        for probes in list(self.codes.values()):
+            monitoring.set_local_events(self.tool_id, probes.code, 0)
+        for event in self.callbacks:
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+
+    def restart(self):
+        """Enable the disabled locations again, after the hits were reset."""
+        # this enables what other tools disabled as well
+        if self.tool_id is not None and not self.counters:
+            monitoring.restart_events()
+
+    def add(self, code, codeobj_id, instructions, blocks, probe_ids, hits,
+            visit, dirty):
+        if hits is None:
+            hits = bytearray(len(blocks))
+        probes = CodeProbes(
+            code, codeobj_id, hits, self.counters, dirty, probe_ids, visit)
+        for slot, (block, rows) in enumerate(blocks):
+            if self.granularity == 'line':
+                line = block[0][1].starts_line
+                if line is not None:
+                    probes.lines.setdefault(line, []).append(slot)
+                continue
+            # a branch may land on any opcode of a block: the unreported
+            # ones it starts with stand for its row. Otherwise the first
+            # row is the probe: the opcodes before it raise no INSTRUCTION
+            # (RESUME) or are jumped over (END_FOR after a loop).
+            if self.granularity != 'branch':
+                block = [
+                    (start, st) for start, st in block
+                    if st.offset == rows[0].offset
+                ]
+            for start, st in block:
+                probes.offsets[start] = probes.offsets[st.offset] = slot
+
+        if self.granularity == 'branch':
+            for index, (start, st) in enumerate(instructions[:-1]):
+                target = Wrapper.get_jump_target(st)
+                if target is None:
+                    continue
+                slots = (
+                    probes.offsets.get(target),
+                    probes.offsets.get(instructions[index + 1][0]),
+                )
+                probes.outcomes[start] = probes.outcomes[st.offset] = [
+                    slot for slot in slots if slot is not None]
+
+        probes.events = self.events
+        if self.watch_start:
+            # only code whose first line has a row of its own, such as a
+            # lambda or a class body, misses that LINE event
+            first_line = next((
+                st.starts_line for _, st in instructions
+                if st.starts_line is not None), None)
+            if first_line not in probes.lines:
+                probes.events &= ~monitoring.events.PY_START
+
+        self.codes[id(code)] = probes
+        if self.tool_id is not None:
+            monitoring.set_local_events(self.tool_id, code, probes.events)
+
+    def on_instruction(self, code, offset):
+        probes = self.codes.get(id(code))
+        if probes is not None:
+            slot = probes.offsets.get(offset)
+            if slot is not None:
+                probes.hit(slot)
+                if self.counters:
+                    return None
+        return monitoring.DISABLE
+
+    def on_start(self, code, offset):
+        # nothing to record: watching PY_START is what makes 3.13 raise
+        # LINE for the first line. Disabled, it would only do so for the
+        # first call, so counters keep it enabled in the code objects
+        # add() watches it in.
+        return None if self.counters else monitoring.DISABLE
+
+    def on_line(self, code, line):
+        probes = self.codes.get(id(code))
+        if probes is not None:
+            slots = probes.lines.get(line)
+            if slots is not None:
+                for slot in slots:
+                    probes.hit(slot)
+                if self.counters:
+                    return None
+        return monitoring.DISABLE
+
+    def on_jump(self, code, offset, destination):
+        probes = self.codes.get(id(code))
+        if probes is None:
+            return monitoring.DISABLE
+        slot = probes.offsets.get(offset)
+        if slot is not None:
+            probes.hit(slot)
+        # a jump landing on a jump is counted by the event of the latter
+        if self.counters and destination in probes.outcomes:
+            return None
+        slot = probes.offsets.get(destination)
+        if slot is not None:
+            probes.hit(slot)
+        return None if self.counters else monitoring.DISABLE
+
+    def on_branch(self, code, offset, destination):
+        if self.on_jump(code, offset, destination) is None:
+            return None
+        # DISABLE turns off both outcomes: wait until both were seen
+        probes = self.codes.get(id(code))
+        if probes is not None:
+            for slot in probes.outcomes.get(offset, ()):
+                if not probes.hits[slot]:
+                    return None
+        return monitoring.DISABLE
+
+
+class MonitoringWrapper(Wrapper):
+    """
+    Takes the place of Wrapper with OpTraceHook(engine='monitoring'): code
+    objects get the same rows, probe ids and hit maps, but run unchanged
+    while the engine watches them.
+    """
+
+    def __init__(self, *args, engine=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = engine
+
+    def wrap_code(self, codeobj, codeobj_id=0):
+        for item in codeobj.co_consts:
+            if isinstance(item, CodeType):
+                self.wrap_nested(item, codeobj_id)
+        instructions = list(self.get_instructions(codeobj))
+        blocks, probe_ids, hits = self.mark_blocks(codeobj_id, instructions)
+        if self.dirty is not None:
+            self.add_dirty(codeobj_id)
+        self.engine.add(
+            codeobj, codeobj_id, instructions, blocks, probe_ids, hits,
+            None if self.probe_mode else self.visit, self.dirty)
+        if self.add_code is not None:
+            # the code object is its own instrumented variant
+            self.add_code(codeobj_id, codeobj, codeobj)
+        return codeobj
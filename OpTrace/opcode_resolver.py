@@ -1,5 +1,12 @@
-import re
-from collections import namedtuple
+import ast
+import io
+import keyword
+import sys
+import tokenize
+
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from functools import partial
 
 # issues:
 # LOAD_CLOSURE - неправильно получаем строку.
@@ -19,276 +26,350 @@ from collections import namedtuple
 MissingOpcode = namedtuple(
     'MissingOpcode', ['line', 'start', 'stop', 'comment'])
 
+
+class SourceIndex:
+    """
+    Column spans of one source file, built once from its tokens and its AST.
+    spans[line, kind, value] is the list of (start, stop) columns, sorted,
+    where kind is one of:
+
+    token      a token or 'not in' / 'is not', value is its string
+    name       a Name node, value is the identifier
+    const      a constant node, value is repr() of the constant
+    attr       `obj.attr` or `.attr`, value is the attribute name
+    del        `del name`, value is the name
+    for        `for ... in`, value is None
+    subscript, list, brace, paren
+               bracket pairs, value is None; a span ends with the line when
+               the closing bracket is on a later one
+
+    Lines are counted from 0 like FileReporter does.
+    """
+    OPENING = {'[': ']', '{': '}', '(': ')'}
+
+    def __init__(self, source):
+        self.source = source
+        self.spans = defaultdict(list)
+        # (line, start column) -> stop column of every token
+        self.token_stops = {}
+        self.add_tokens()
+        self.add_nodes()
+        for spans in self.spans.values():
+            spans.sort()
+
+    def add(self, line, kind, value, start, stop):
+        self.spans[line, kind, value].append((start, stop))
+
+    def iter_tokens(self):
+        readline = io.StringIO('\n'.join(self.source) + '\n').readline
+        skip = (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT)
+        try:
+            for token in tokenize.generate_tokens(readline):
+                if token[0] not in skip:
+                    yield token
+        except (tokenize.TokenError, SyntaxError):
+            # an index of what could be read is still useful
+            return
+
+    def get_bracket_kind(self, string, previous):
+        if string == '{':
+            return 'brace'
+        # after a value the bracket subscripts or calls it
+        follows_value = previous is not None and (
+            previous[0] == tokenize.STRING
+            or previous[1] in (')', ']', '}')
+            or previous[0] == tokenize.NAME
+            and not keyword.iskeyword(previous[1])
+        )
+        if string == '[':
+            return 'subscript' if follows_value else 'list'
+        return 'call' if follows_value else 'paren'
+
+    def add_tokens(self):
+        brackets = []
+        loops = []
+        previous = before = None
+        for token in self.iter_tokens():
+            kind, string, (line, start), (end_line, stop), _ = token
+            line -= 1
+            if end_line - 1 == line:
+                self.token_stops[line, start] = stop
+                self.add(line, 'token', string, start, stop)
+
+            if string in self.OPENING:
+                brackets.append(
+                    (line, start, self.get_bracket_kind(string, previous)))
+            elif string in (')', ']', '}') and brackets:
+                open_line, open_start, bracket = brackets.pop()
+                self.add(
+                    open_line, bracket, None, open_start,
+                    stop if open_line == line else len(self.source[open_line]))
+            elif kind == tokenize.NAME and string == 'for':
+                loops.append((line, start, len(brackets)))
+            elif kind == tokenize.NAME and string == 'in' and loops and (
+                    loops[-1][2] == len(brackets)):
+                loop_line, loop_start, _ = loops.pop()
+                self.add(
+                    loop_line, 'for', None, loop_start,
+                    stop if loop_line == line else len(self.source[loop_line]))
+
+            if previous is not None and previous[2][0] - 1 == line:
+                previous_start = previous[2][1]
+                pair = '{} {}'.format(previous[1], string)
+                if pair in ('not in', 'is not'):
+                    self.add(line, 'token', pair, previous_start, stop)
+                elif previous[1] == 'del' and kind == tokenize.NAME:
+                    self.add(line, 'del', string, previous_start, stop)
+                elif previous[1] == '.' and kind == tokenize.NAME:
+                    if before is not None and before[0] == tokenize.NAME and (
+                            before[2][0] - 1 == line):
+                        previous_start = before[2][1]
+                    self.add(line, 'attr', string, previous_start, stop)
+            before, previous = previous, token
+
+    def get_constant(self, node):
+        """(True, value) for constant nodes, (False, None) for the rest."""
+        if sys.version_info >= (3, 8):
+            if isinstance(node, ast.Constant):
+                return True, node.value
+            return False, None
+        if isinstance(node, ast.Num):
+            return True, node.n
+        if isinstance(node, (ast.Str, ast.Bytes)):
+            return True, node.s
+        if isinstance(node, ast.NameConstant):
+            return True, node.value
+        return False, None
+
+    def get_stop(self, node, line, default=None):
+        # end_col_offset is 3.8+, before that a node ends with its token
+        if getattr(node, 'end_lineno', None) == node.lineno:
+            return node.end_col_offset
+        return self.token_stops.get((line, node.col_offset), default)
+
+    def add_nodes(self):
+        try:
+            tree = ast.parse('\n'.join(self.source))
+        except (SyntaxError, ValueError):
+            return
+        for node in ast.walk(tree):
+            if getattr(node, 'col_offset', -1) < 0:
+                continue
+            line = node.lineno - 1
+            if isinstance(node, ast.Name):
+                self.add(
+                    line, 'name', node.id, node.col_offset,
+                    self.get_stop(node, line, node.col_offset + len(node.id)))
+                continue
+
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+                # -1 is folded into a single constant by the compiler
+                is_constant, value = self.get_constant(node.operand)
+                if not is_constant or isinstance(value, (str, bytes)):
+                    continue
+                value = -value
+                stop = self.get_stop(node.operand, line)
+            else:
+                is_constant, value = self.get_constant(node)
+                if not is_constant:
+                    continue
+                stop = self.get_stop(node, line)
+            if stop is not None:
+                self.add(line, 'const', repr(value), node.col_offset, stop)
+
+    def find(self, line, kind, value, column=0):
+        """The first span starting at `column` or later, else the first one."""
+        spans = self.spans.get((line, kind, value))
+        if not spans:
+            return None
+        index = bisect_left(spans, (column, 0))
+        return spans[index] if index < len(spans) else spans[0]
+
+
 class OpcodeResolver:
     skip_opnames = [
         'NOP', 'POP_TOP', 'ROT_TWO', 'ROT_THREE', 'DUP_TOP', 'DUP_TOP_TWO',
         'CALL_FUNCTION', 'POP_TOP', 'PRINT_EXPR', 'POP_BLOCK', 'POP_EXCEPT',
         'LOAD_BUILD_CLASS', 'MAKE_FUNCTION', 'CALL_FUNCTION_VAR', 'CALL_FUNCTION_KW',
-        'CALL_FUNCTION_VAR_KW', 'HAVE_ARGUMENT'
+        'CALL_FUNCTION_VAR_KW', 'HAVE_ARGUMENT',
 
         # Async opcodes
         'GET_AWAITABLE', 'GET_AITER', 'GET_ANEXT', 'BEFORE_ASYNC_WITH',
         'SETUP_ASYNC_WITH',
         # Exceptions
-        'END_FINALLY', 'SETUP_EXCEPT', 'SETUP_FINALLY'
+        'END_FINALLY', 'SETUP_EXCEPT', 'SETUP_FINALLY',
 
         # Maybe resolve?
         'SETUP_WITH', 'WITH_CLEANUP_START', 'WITH_CLEANUP_FINISH',
-        'SETUP_LOOP', ''
+        'SETUP_LOOP',
         'JUMP_IF_TRUE_OR_POP', 'JUMP_IF_FALSE_OR_POP', 'JUMP_ABSOLUTE'
     ]
 
-    def resolve(self, opcode, line, source, prev_position):
-        resolver = getattr(self, '_{}'.format(opcode.opname), None)
+    # opname -> the token it comes from
+    SYMBOLS = {
+        'BREAK_LOOP': 'break',
+        'CONTINUE_LOOP': 'continue',
+        'UNARY_NOT': 'not',
+        'UNARY_INVERT': '~',
+        'SETUP_WITH': 'with',
+        'BINARY_POWER': '**',
+        'BINARY_MULTIPLY': '*',
+        'BINARY_MATRIX_MULTIPLY': '@',
+        'BINARY_FLOOR_DIVIDE': '//',
+        'BINARY_TRUE_DIVIDE': '/',
+        'BINARY_MODULO': '%',
+        'BINARY_ADD': '+',
+        'BINARY_SUBTRACT': '-',
+        'BINARY_LSHIFT': '<<',
+        'BINARY_RSHIFT': '>>',
+        'BINARY_AND': '&',
+        'BINARY_XOR': '^',
+        'BINARY_OR': '|',
+        'INPLACE_POWER': '**=',
+        'INPLACE_MULTIPLY': '*=',
+        'INPLACE_MATRIX_MULTIPLY': '@=',
+        'INPLACE_FLOOR_DIVIDE': '//=',
+        'INPLACE_TRUE_DIVIDE': '/=',
+        'INPLACE_MODULO': '%=',
+        'INPLACE_ADD': '+=',
+        'INPLACE_SUBTRACT': '-=',
+        'INPLACE_LSHIFT': '<<=',
+        'INPLACE_RSHIFT': '>>=',
+        'INPLACE_AND': '&=',
+        'INPLACE_XOR': '^=',
+        'INPLACE_OR': '|=',
+    }
+    # one opcode for all of the above from 3.11 on, its argrepr is the token
+    OPERATORS = ('BINARY_OP',)
+
+    # opname -> the bracket pair it comes from
+    BRACKETS = {
+        'BINARY_SUBSCR': 'subscript',
+        'STORE_SUBSCR': 'subscript',
+        'DELETE_SUBSCR': 'subscript',
+        'BUILD_SLICE': 'subscript',
+        'BUILD_LIST': 'list',
+        'LIST_APPEND': 'list',
+        'BUILD_SET': 'brace',
+        'SET_ADD': 'brace',
+        'BUILD_MAP': 'brace',
+        'MAP_ADD': 'brace',
+        'BUILD_TUPLE': 'paren',
+    }
+
+    NAMES = (
+        'LOAD_FAST', 'STORE_FAST', 'LOAD_NAME', 'STORE_NAME', 'LOAD_GLOBAL',
+        'STORE_GLOBAL', 'LOAD_DEREF', 'STORE_DEREF', 'LOAD_CLASSDEREF',
+        'LOAD_FAST_CHECK', 'LOAD_FAST_AND_CLEAR',
+    )
+    # 3.13 superinstructions of two names, argrepr 'first, second'
+    NAME_PAIRS = (
+        'LOAD_FAST_LOAD_FAST', 'STORE_FAST_LOAD_FAST', 'STORE_FAST_STORE_FAST',
+    )
+    DELETES = ('DELETE_NAME', 'DELETE_FAST', 'DELETE_GLOBAL', 'DELETE_DEREF')
+    ATTRIBUTES = ('LOAD_ATTR', 'STORE_ATTR', 'DELETE_ATTR', 'LOAD_SUPER_ATTR')
+    LOOPS = ('FOR_ITER', 'GET_ITER')
+    CALLS = ('CALL', 'CALL_KW', 'CALL_FUNCTION_EX')
+    # the whole statement is reported
+    LINES = (
+        'POP_JUMP_IF_FALSE', 'RETURN_VALUE', 'YIELD_VALUE', 'YIELD_FROM',
+        'UNPACK_SEQUENCE', 'UNPACK_EX', 'RAISE_VARARGS', 'IMPORT_NAME',
+        'IMPORT_FROM', 'IMPORT_STAR',
+        'RETURN_CONST', 'JUMP_BACKWARD', 'POP_JUMP_IF_NONE',
+        'POP_JUMP_IF_NOT_NONE',
+    )
+    # LOAD_GLOBAL and LOAD_ATTR that also push a NULL (or self) for a call
+    # show it in argrepr, 'NULL + name' on 3.12 and 'name + NULL' on 3.13
+    NULL_PREFIXES = ('NULL|self + ', 'NULL + ')
+    NULL_SUFFIXES = (' + NULL|self', ' + NULL')
+
+    def __init__(self, source):
+        self.source = source
+        self.index = None
+        # opname -> resolver(opcode, line, prev_position) returning
+        # (line, start, stop) or None
+        self.resolvers = {'POP_JUMP_IF_TRUE': self.missing_jump}
+        for opname, symbol in self.SYMBOLS.items():
+            self.resolvers[opname] = partial(self.missing_span, 'token', symbol)
+        for opname, bracket in self.BRACKETS.items():
+            self.resolvers[opname] = partial(self.missing_span, bracket, None)
+        for opname in self.OPERATORS:
+            self.resolvers[opname] = partial(self.missing_argument, 'token')
+        for opname in self.LOOPS:
+            self.resolvers[opname] = partial(self.missing_span, 'for', None)
+        for opname in self.CALLS:
+            self.resolvers[opname] = partial(self.missing_span, 'call', None)
+        for opname in self.NAMES:
+            self.resolvers[opname] = self.missing_name
+        for opname in self.NAME_PAIRS:
+            self.resolvers[opname] = self.missing_name_pair
+        for opname in self.DELETES:
+            self.resolvers[opname] = partial(self.missing_argument, 'del')
+        for opname in self.ATTRIBUTES:
+            self.resolvers[opname] = self.missing_attribute
+        for opname in self.LINES:
+            self.resolvers[opname] = self.missing_line
+        self.resolvers['LOAD_CONST'] = partial(self.missing_argument, 'const')
+        self.resolvers['COMPARE_OP'] = partial(self.missing_argument, 'token')
+
+    def resolve(self, opcode, line, prev_position):
+        resolver = self.resolvers.get(opcode.opname)
         if resolver is None:
             return
+        if self.index is None:
+            # built on the first miss, a fully covered file never pays for it
+            self.index = SourceIndex(self.source)
 
-        data = resolver(opcode, line, source, prev_position)
-        if not data:
-            return
-
-        return MissingOpcode(data.line, data.start, data.stop, opcode.opname)
-
-    def find_index(self, source, substr, start):
-        try:
-            return source.index(substr, start)
-        except ValueError:
-            if start>0:
-                return self.find_index(source, substr, 0)
-            print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-            print(source)
-            print(substr)
-
-    def missing_by_regexp(self, line, source, regexp):
-        found = re.search(regexp, source)
+        found = resolver(opcode, line, prev_position)
         if not found:
             return
-        return MissingOpcode(line, found.start(1), found.end(1), '')
+        return MissingOpcode(found[0], found[1], found[2], opcode.opname)
 
-    def missing_symbol(self, line, source, prev_position, symbol):
+    def missing_span(self, kind, value, opcode, line, prev_position):
+        # prefer the occurrence after the last one seen on this line
         last_line, position = prev_position
-        index = self.find_index(source, symbol, position)
-        if not index:
+        span = self.index.find(
+            line, kind, value, position if last_line == line else 0)
+        if span is None:
             return
-        return MissingOpcode(line, index, index + len(symbol), '')
-
-    def vars_and_const(self, opcode, line, source, prev_position):
-        regexp = r'(?:\W|\s)(dumper)(?:\W|\s)'.format(re.escape(opcode.argrepr))
-        return self.missing_by_regexp(line, source, regexp)
-        # return self.missing_symbol(line, source, prev_position, opcode.argrepr)
-
-    def missing_line(self, line, source, comment):
-        line_len = len(source)
-        line_stripped = len(source.lstrip())
-        return MissingOpcode(line, line_len-line_stripped, line_len, comment)
-
-    def _BREAK_LOOP(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, 'break')
-
-    def _CONTINUE_LOOP(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, 'continue')
-
-    def _UNARY_NOT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, 'not')
-
-    def _UNARY_INVERT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '~')
-
-    def _STORE_NAME(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _DELETE_NAME(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, 'del '+opcode.argrepr)
-
-    def _LOAD_GLOBAL(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _STORE_GLOBAL(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _LOAD_FAST(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _LOAD_CONST(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _LOAD_NAME(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _LOAD_DEREF(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _COMPARE_OP(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _STORE_FAST(self, opcode, line, source, prev_position):
-        return self.vars_and_const(opcode, line, source, prev_position)
-
-    def _POP_JUMP_IF_TRUE(self, opcode, line, source, prev_position):
-        line, position = prev_position
-        return MissingOpcode(line, position+1, position+2, 'Never True')
-
-    def _POP_JUMP_IF_FALSE(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, 'Never False')
-
-    def _RETURN_VALUE(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, 'Never returned')
-
-    def _YIELD_VALUE(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, 'Never yielded')
-
-    def _YIELD_FROM(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, 'Never yielded from')
-
-    def _BINARY_POWER(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '**')
-
-    def _BINARY_MULTIPLY(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '*')
-
-    def _BINARY_MATRIX_MULTIPLY(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '@')
-
-    def _BINARY_FLOOR_DIVIDE(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '//')
-
-    def _BINARY_TRUE_DIVIDE(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '/')
-
-    def _BINARY_MODULO(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '%')
-
-    def _BINARY_ADD(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '+')
-
-    def _BINARY_SUBTRACT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '-')
-
-    def _BINARY_SUBSCR(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\[.+?\])')
-
-    def _BINARY_LSHIFT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source,prev_position, '<<')
-
-    def _BINARY_RSHIFT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source,prev_position, '>>')
-
-    def _BINARY_AND(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source,prev_position, '&')
-
-    def _BINARY_XOR(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source,prev_position, '^')
-
-    def _BINARY_OR(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source,prev_position, '|')
-
-    def _INPLACE_POWER(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '**')
-
-    def _INPLACE_MULTIPLY(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '*')
-
-    def _INPLACE_MATRIX_MULTIPLY(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '@')
-
-    def _INPLACE_FLOOR_DIVIDE(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '//')
-
-    def _INPLACE_TRUE_DIVIDE(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '/')
-
-    def _INPLACE_MODULO(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '%')
-
-    def _INPLACE_ADD(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '+')
-
-    def _INPLACE_SUBTRACT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '-')
-
-    def _INPLACE_LSHIFT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '<<')
-
-    def _INPLACE_RSHIFT(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '>>')
-
-    def _INPLACE_AND(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '&')
-
-    def _INPLACE_XOR(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '^')
-
-    def _INPLACE_OR(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, '|')
-
-    def _STORE_SUBSCR(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\S+\[.+?\])')
-
-    def _DELETE_SUBSCR(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, '')
-
-    def _SET_ADD(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'\{(\S+)')
-
-    def _LIST_APPEND(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'\[(\S+)')
-
-    def _MAP_ADD(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'\{(\w+\s*:\s*\S+)')
-
-    def _IMPORT_STAR(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, r'import *')
-
-    def _SETUP_WITH(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, r'with ')
-
-    def _UNPACK_SEQUENCE(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, '')
-
-    def _UNPACK_EX(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, '')
-
-    def _RAISE_VARARGS(self, opcode, line, source, prev_position):
-        return self.missing_line(line, source, '')
-
-    def _STORE_ATTR(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\w+\.\w+\s*=)')
-
-    def _DELETE_ATTR(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(del\s*\w+\.\w+)')
-
-    def _DELETE_GLOBAL(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(del\s*\w+)')
-
-    def _DELETE_FAST(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(del\s*\w+)')
-
-    def _BUILD_TUPLE(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\((\w*,?\s*)*\))')
-
-    def _BUILD_LIST(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\[(\w*,?\s*)*\])')
-
-    def _BUILD_SET(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\{(\w*,?\s*)*\})')
-
-    def _BUILD_MAP(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\{(\w*\s*:\s*\w*,?\s*)*\})')
-
-    def _LOAD_ATTR(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\w+\.\w+)')
-
-    def _IMPORT_NAME(self, opcode, line, source, prev_position):
-        return self.missing_symbol(line, source, prev_position, opcode.argrepr)
-
-    def _IMPORT_FROM(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(from\s*\S+\s*import\s*\S+)')
-
-    def _FOR_ITER(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(for\s*.+?\s*in\s*.+?)')
-
-    def _GET_ITER(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(for\s*.+?\s*in\s*.+?)')
-
-    def _BUILD_SLICE(self, opcode, line, source, prev_position):
-        return self.missing_by_regexp(line, source, r'(\S+\[\w*:\w*:?\w*\])')
+        return (line,) + span
+
+    def missing_argument(self, kind, opcode, line, prev_position):
+        return self.missing_span(
+            kind, opcode.argrepr, opcode, line, prev_position)
+
+    def get_name(self, argrepr):
+        for prefix in self.NULL_PREFIXES:
+            if argrepr.startswith(prefix):
+                return argrepr[len(prefix):]
+        for suffix in self.NULL_SUFFIXES:
+            if argrepr.endswith(suffix):
+                return argrepr[:-len(suffix)]
+        return argrepr
+
+    def missing_attribute(self, opcode, line, prev_position):
+        return self.missing_span(
+            'attr', self.get_name(opcode.argrepr), opcode, line, prev_position)
+
+    def missing_name(self, opcode, line, prev_position, name=None):
+        # names bound by def, class or import have no Name node
+        if name is None:
+            name = self.get_name(opcode.argrepr)
+        return (
+            self.missing_span('name', name, opcode, line, prev_position)
+            or self.missing_span('token', name, opcode, line, prev_position)
+        )
+
+    def missing_name_pair(self, opcode, line, prev_position):
+        # the span of the first name, the one used first
+        return self.missing_name(
+            opcode, line, prev_position, opcode.argrepr.split(', ')[0])
+
+    def missing_line(self, opcode, line, prev_position):
+        source = self.source[line]
+        return line, len(source) - len(source.lstrip()), len(source)
+
+    def missing_jump(self, opcode, line, prev_position):
+        # the condition right before the jump
+        last_line, position = prev_position
+        return last_line, position + 1, position + 2
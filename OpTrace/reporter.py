@@ -1,14 +1,21 @@
+import heapq
+
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from OpTrace.datafile import DataFile
 from OpTrace.opcode_resolver import OpcodeResolver
+from OpTrace.wrapped_opcode import FileOpcode
 
 
 class FileReporter:
     def __init__(self, data):
+        data.collect()
         self.module = data.module
-        self.opcodes = data.opcodes
+        self.data = data
         self.source = data.source
 
-        self.resolve = OpcodeResolver().resolve
+        self.resolve = OpcodeResolver(self.source).resolve
 
         self.missing_positions = defaultdict(list)
         self.cannot_represent = defaultdict(list)
@@ -16,19 +23,23 @@ class FileReporter:
     def log(self, *args):
         print(*args)
 
-    def add_missing(self, opcode, line, source, prev_position):
-        missing = self.resolve(opcode, line, source, prev_position)
+    def add_missing(self, opcode, line, prev_position):
+        missing = self.resolve(opcode, line, prev_position)
         if missing:
-            self.missing_positions[(missing.line, missing.comment)].extend(
-                range(missing.start, missing.stop))
+            self.missing_positions[(missing.line, missing.comment)].append(
+                (missing.start, missing.stop))
         else:
             self.cannot_represent[line].append(opcode)
 
     def analyze(self):
+        if not self.source:
+            # an empty module, such as the __init__ of a package: its code
+            # has no source to point at
+            return
         line_lumber = 0
         line_source = self.source[line_lumber]
         prev_position = (0, 0)
-        for key, opcode in sorted(self.opcodes.items()):
+        for opcode in self.data.iter_opcodes():
             if opcode.starts_line:
                 line_lumber = opcode.starts_line-1
                 line_source = self.source[line_lumber]
@@ -40,42 +51,147 @@ class FileReporter:
             if opcode.visited:
                 continue
 
-            self.add_missing(opcode, line_lumber, line_source, prev_position)
+            self.add_missing(opcode, line_lumber, prev_position)
+
+    @staticmethod
+    def merge_spans(spans, limit):
+        """Sorted, non-overlapping (start, stop) spans clipped to limit."""
+        merged = []
+        for start, stop in sorted(spans):
+            start, stop = max(start, 0), min(stop, limit)
+            if start >= stop:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
 
-    def make_report_line(self, line, reason, indexes):
+    def make_report_line(self, line, reason, spans):
         num = '{: >4}:'.format(line)
         source = '{} {}'.format(num, self.source[line])
+        underline = []
+        position = 0
+        for start, stop in self.merge_spans(spans, len(self.source[line])):
+            underline.append(' ' * (start - position) + '^' * (stop - start))
+            position = stop
         underline = '{left_spaces} {underline} {reason}'.format(
             left_spaces=' ' * len(num),
             reason=reason,
-            underline=''.join(
-                '^' if index in indexes else ' '
-                for index in range(len(self.source[line]))
-            ).rstrip(),
+            underline=''.join(underline),
         )
         return '{}\n{}'.format(source, underline)
 
-    def report(self):
+    def iter_report(self):
         self.analyze()
-        self.log('----------- Report {} --------------'.format(self.module))
-        for (line, reason), indexes in sorted(self.missing_positions.items()):
-            self.log(self.make_report_line(line, reason, indexes))
+        yield '----------- Report {} --------------'.format(self.module)
+        for (line, reason), spans in sorted(self.missing_positions.items()):
+            yield self.make_report_line(line, reason, spans)
         if self.cannot_represent:
-            self.log('--- cannot represent ---')
+            yield '--- cannot represent ---'
             for line, opcodes in self.cannot_represent.items():
-                self.log('Last known source line:')
-                self.log(self.source[line])
-                self.log('Opcodes:')
+                yield 'Last known source line:'
+                yield self.source[line]
+                yield 'Opcodes:'
                 for opcode in opcodes:
-                    self.log(' - {}'.format(opcode))
-                self.log('------------------------')
+                    yield ' - {}'.format(opcode)
+                yield '------------------------'
+
+    def report(self):
+        for line in self.iter_report():
+            self.log(line)
+
+
+def render_module(module, source, entry):
+    """
+    Report text of one module, in a worker process: the coverage comes in
+    as a DataFile entry, which pickles cheaply, and is decoded there.
+    """
+    data = FileOpcode(module, source)
+    DataFile().merge([(module,) + entry], {module: data})
+    return '\n'.join(FileReporter(data).iter_report())
+
 
 class CommonReporter:
-    def __init__(self, module_opcodes):
-        self.reporters = [
-            FileReporter(data) for data in module_opcodes.values()
-        ]
+    """
+    Reports of every module, one after another or, with workers > 1,
+    analyzed in a process pool and printed in module order as they arrive.
+    """
+
+    def __init__(self, module_opcodes, workers=None):
+        self.module_opcodes = module_opcodes
+        self.workers = workers
+        self.reporters = []
+        if not self.parallel:
+            self.reporters = [
+                FileReporter(data) for data in module_opcodes.values()
+            ]
+
+    @property
+    def parallel(self):
+        return self.workers is not None and self.workers > 1
+
+    def log(self, *args):
+        print(*args)
+
+    def report(self):
+        if not self.parallel:
+            for reporter in self.reporters:
+                reporter.report()
+            return
+
+        data_file = DataFile()
+        modules, sources, entries = [], [], []
+        for data in self.module_opcodes.values():
+            data.collect()
+            modules.append(data.module)
+            sources.append(data.source)
+            entries.append(data_file.encode(data))
+        chunksize = max(1, len(modules) // (self.workers * 4))
+        with ProcessPoolExecutor(self.workers) as executor:
+            for text in executor.map(
+                    render_module, modules, sources, entries,
+                    chunksize=chunksize):
+                self.log(text)
+
+
+class HotReporter:
+    def __init__(self, module_opcodes, top=20):
+        self.module_opcodes = module_opcodes
+        self.top = top
+
+    def log(self, *args):
+        print(*args)
+
+    def iter_counts(self):
+        for module, data in self.module_opcodes.items():
+            data.collect()
+            line = None
+            for opcode in data.iter_opcodes():
+                if opcode.starts_line:
+                    line = opcode.starts_line
+                if opcode.count:
+                    yield opcode.count, module, line, opcode
 
     def report(self):
-        for reporter in self.reporters:
-            reporter.report()
+        counts = list(self.iter_counts())
+        lines = defaultdict(int)
+        for count, module, line, _ in counts:
+            # every opcode of a line runs as often as the line itself,
+            # so the busiest one is the line count
+            lines[module, line] = max(lines[module, line], count)
+
+        self.log('----------- Hot opcodes --------------')
+        for count, module, line, opcode in heapq.nlargest(
+                self.top, counts, key=itemgetter(0)):
+            self.log('{: >12} {}:{} {} {}'.format(
+                count, module, line, opcode.opname, opcode.argrepr))
+
+        self.log('----------- Hot lines --------------')
+        for (module, line), count in heapq.nlargest(
+                self.top, lines.items(), key=itemgetter(1)):
+            source = self.module_opcodes[module].source
+            self.log('{: >12} {}:{} {}'.format(
+                count, module, line,
+                source[line - 1].strip() if line and line <= len(source)
+                else ''))
@@ -0,0 +1,54 @@
+from types import FunctionType
+
+
+def unwrap(value, closures=False, seen=None):
+    # staticmethod/classmethod, property accessors and functools.wraps
+    # decorators all keep the function they wrap around; with closures,
+    # so do the cells of the functions found
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    if isinstance(value, (staticmethod, classmethod)):
+        yield from unwrap(value.__func__, closures, seen)
+    elif isinstance(value, property):
+        for accessor in (value.fget, value.fset, value.fdel):
+            if accessor is not None:
+                yield from unwrap(accessor, closures, seen)
+    elif isinstance(value, FunctionType):
+        yield value
+        wrapped = getattr(value, '__wrapped__', None)
+        if wrapped is not None:
+            yield from unwrap(wrapped, closures, seen)
+        if not closures:
+            return
+        for cell in value.__closure__ or ():
+            try:
+                contents = cell.cell_contents
+            except ValueError:
+                # a cell that was never assigned
+                continue
+            yield from unwrap(contents, closures, seen)
+
+
+def iter_functions(namespace, module_name=None, seen=None, closures=False):
+    """
+    Functions reachable from a module namespace: module level functions and
+    the methods of classes defined in that module, nested classes included.
+    With closures, functions held in closure cells (decorated functions,
+    say) are found too; closures only reachable from other frames are not.
+    """
+    if module_name is None:
+        module_name = namespace.get('__name__')
+    if seen is None:
+        seen = set()
+    for value in list(namespace.values()):
+        if not isinstance(value, type):
+            yield from unwrap(value, closures, seen)
+            continue
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if getattr(value, '__module__', None) == module_name:
+            yield from iter_functions(vars(value), module_name, seen, closures)
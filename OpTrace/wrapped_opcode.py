@@ -1,39 +1,566 @@
+import threading
+import weakref
+
+from array import array
+from bisect import bisect_left
+from opcode import opname
+from types import CodeType
+
+from OpTrace.wrapper import Wrapper
+
+
+TO_ASCII = bytes.maketrans(b'\x00\x01', b'01')
+
+
 class FileOpcode:
-    def __init__(self, module, source):
+    """
+    Coverage data of one module, kept column-wise: row `probe_id` of the
+    parallel arrays below describes one instruction and `visited[probe_id]`
+    tells whether it ran. Rows of a code object are contiguous and sorted by
+    offset, `code_rows[codeobj_id]` is their [start, stop) range.
+    """
+
+    def __init__(self, module, source, thread_buffers=False,
+                 granularity='opcode'):
         self.module = module
         self.source = source
-        self.opcodes = {}
+        # of the wrapper, for list_code
+        self.granularity = granularity
+        # file the source was read from, set by the import hook
+        self.path = None
+
+        self.codeobj_ids = array('L')
+        self.offsets = array('L')
+        self.ops = array('B')
+        self.args = array('q')
+        self.lines = array('L')
+        self.argreprs = array('L')
+        self.jump_targets = bytearray()
+        self.visited = bytearray()
+        # only allocated once counters are collected
+        self.counts = None
+        # counters combined from other processes, by probe id
+        self.merged_counts = {}
+        self.strings = []
+        self.string_ids = {}
+        self.code_rows = {}
+
+        self.hits = {}
+        # hits moved out of the hit maps by drain(), slot for slot
+        self.drained = {}
+        self.codes = {}
+        self.original_ids = {}
+        self.instrumented_ids = {}
+        # set by instrumented code as it runs, see Wrapper.dirty
+        self.dirty = bytearray()
+        # hit maps as of the last snapshot, by code object
+        self.snapshots = {}
+        self.retired = {}
+        self.parents = {}
+        self.pending = {}
+        self.stubs = {}
+
+        # per-thread copies of visited and the hit maps, merged on collect
+        self.lock = threading.Lock()
+        self.buffers = ThreadBuffers(self) if thread_buffers else None
+        self.thread_visited = []
+        self.thread_hits = {}
+        # codeobj_id -> the thread hit map that ended threads are folded into
+        self.folded_hits = {}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def find(self, codeobj_id, offset):
+        start, stop = self.code_rows.get(codeobj_id, (0, 0))
+        probe_id = bisect_left(self.offsets, offset, start, stop)
+        if probe_id < stop and self.offsets[probe_id] == offset:
+            return probe_id
+        return None
+
+    def get_string(self, value):
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+    def add_row(self, codeobj_id, offset, op, arg, line, argrepr,
+                is_jump_target):
+        """Add one instruction (once) and return its probe id."""
+        probe_id = self.find(codeobj_id, offset)
+        if probe_id is not None:
+            return probe_id
+
+        probe_id = len(self.offsets)
+        rows = self.code_rows.setdefault(codeobj_id, [probe_id, probe_id])
+        if rows[1] != probe_id:
+            raise ValueError(
+                'Rows of code object {} are not contiguous'.format(codeobj_id))
+        rows[1] += 1
+
+        self.codeobj_ids.append(codeobj_id)
+        self.offsets.append(offset)
+        self.ops.append(op)
+        self.args.append(-1 if arg is None else arg)
+        self.lines.append(line or 0)
+        self.argreprs.append(self.get_string(argrepr))
+        self.jump_targets.append(bool(is_jump_target))
+        self.visited.append(0)
+        if self.counts is not None:
+            self.counts.append(0)
+        return probe_id
 
     def add(self, codeobj_id, offset, instruction):
-        self.opcodes[codeobj_id, offset] = WrappedOpcode(instruction)
+        return self.add_row(
+            codeobj_id, offset, instruction.opcode, instruction.arg,
+            instruction.starts_line, instruction.argrepr,
+            instruction.is_jump_target,
+        )
+
+    def get_row(self, probe_id):
+        """The add_row arguments that follow codeobj_id."""
+        return (
+            self.offsets[probe_id], self.ops[probe_id],
+            self.args[probe_id], self.lines[probe_id],
+            self.strings[self.argreprs[probe_id]],
+            self.jump_targets[probe_id],
+        )
+
+    def get_rows(self, codeobj_id):
+        start, stop = self.code_rows[codeobj_id]
+        return [self.get_row(probe_id) for probe_id in range(start, stop)]
+
+    def iter_opcodes(self):
+        """Row views in (codeobj_id, offset) order."""
+        for _, (start, stop) in sorted(self.code_rows.items()):
+            for probe_id in range(start, stop):
+                yield WrappedOpcode(self, probe_id)
+
+    def add_hits(self, codeobj_id, hits, bounds):
+        # hits[slot] covers rows bounds[slot]:bounds[slot + 1] of the code
+        # object, counted from its first row
+        self.hits[codeobj_id] = hits, array('L', bounds)
+
+    def add_code(self, codeobj_id, original, instrumented):
+        self.codes[codeobj_id] = original, instrumented
+        self.original_ids[id(original)] = codeobj_id
+        self.instrumented_ids[id(instrumented)] = codeobj_id
+        # nested code objects are wrapped (and added) before their parent
+        for item in original.co_consts:
+            if id(item) in self.original_ids:
+                self.parents[self.original_ids[id(item)]] = codeobj_id
+
+    def add_pending(self, codeobj_id, original, stub):
+        self.pending[codeobj_id] = original
+        self.stubs[codeobj_id] = stub
+        self.original_ids[id(original)] = codeobj_id
+
+    def current_code(self, original):
+        codeobj_id = self.original_ids.get(id(original))
+        if codeobj_id is None:
+            return original
+        if codeobj_id in self.retired:
+            return self.retired[codeobj_id]
+        if codeobj_id in self.codes:
+            return self.codes[codeobj_id][1]
+        return self.stubs[codeobj_id]
+
+    def list_code(self, codeobj_id, codeobj):
+        # what wrap_code would mark, without instrumenting anything;
+        # returns the id that follows the whole nested tree
+        wrapper = Wrapper(None, None, granularity=self.granularity)
+        instructions = list(wrapper.get_instructions(codeobj))
+        blocks = wrapper.make_blocks(instructions)
+        for rows in wrapper.get_rows(instructions, blocks):
+            for st in rows:
+                self.add(codeobj_id, st.offset, st)
+        next_id = codeobj_id + 1
+        for item in codeobj.co_consts:
+            if isinstance(item, CodeType):
+                next_id = self.list_code(next_id, item)
+        return next_id
+
+    def completed(self):
+        """Ids of the instrumented code objects whose every probe has fired."""
+        self.merge()
+        if self.hits:
+            return [
+                codeobj_id
+                for codeobj_id, (hits, _) in list(self.hits.items())
+                if 0 not in hits
+            ]
+        # code that Wrapper.mark_blocks gave no rows has no probes
+        return [
+            codeobj_id for codeobj_id in list(self.codes)
+            if codeobj_id in self.code_rows
+            and 0 not in self.visited[slice(*self.code_rows[codeobj_id])]
+        ]
+
+    def visit(self, probe_id):
+        self.visited[probe_id] = 1
+
+    def merge_row(self, codeobj_id, row, visited, count):
+        """Add what another process recorded for one instruction."""
+        probe_id = self.add_row(codeobj_id, *row)
+        if visited:
+            self.visited[probe_id] = 1
+        if count:
+            self.merged_counts[probe_id] = (
+                self.merged_counts.get(probe_id, 0) + count)
+
+    def reset(self):
+        """
+        Forget every hit recorded so far, in place: instrumented code keeps
+        its references to the maps. Used in forked children, which would
+        otherwise report the parent's hits once more.
+        """
+        # another thread may have held the lock at fork time
+        self.lock = threading.Lock()
+        self.visited[:] = bytes(len(self.visited))
+        maps = [hits for hits, _ in self.hits.values()]
+        maps.extend(self.thread_visited)
+        self.clear_maps(maps)
+        self.clear_hit_buffers()
+        self.counts = None
+        self.merged_counts = {}
+        self.drained = {}
+        self.snapshots = {}
+
+    @staticmethod
+    def clear_maps(maps):
+        # in place, instrumented code holds references to them
+        for hits in maps:
+            if isinstance(hits, array):
+                hits[:] = array(hits.typecode, [0]) * len(hits)
+            else:
+                hits[:] = bytes(len(hits))
 
-    def visit(self, codeobj_id, offset, instruction):
-        key = codeobj_id, offset
-        if key not in self.opcodes:
+    def clear_hit_buffers(self):
+        for buffers in self.thread_hits.values():
+            self.clear_maps(buffers)
+
+    @staticmethod
+    def to_bits(flags):
+        """0/1 bytes as an int, row 0 being the lowest bit."""
+        if not flags:
+            return 0
+        return int(bytes(flags).translate(TO_ASCII)[::-1], 2)
+
+    def drain(self):
+        """
+        Take what the hit maps recorded since the last drain: the maps are
+        zeroed, their hits kept in drained for collect(), and the probe ids
+        that were hit are returned as an int bitset. Hits of threads that
+        record while this runs may end up in either side.
+        """
+        self.merge()
+        flags = bytearray(len(self))
+        with self.lock:
+            for codeobj_id, (hits, bounds) in list(self.hits.items()):
+                counting = not isinstance(hits, bytearray)
+                drained = self.drained.get(codeobj_id)
+                if drained is None:
+                    drained = Wrapper.make_hit_map(len(hits), counting)
+                    self.drained[codeobj_id] = drained
+                start = self.code_rows[codeobj_id][0]
+                for slot, hit in enumerate(hits):
+                    if not hit:
+                        continue
+                    drained[slot] = drained[slot] + hit if counting else 1
+                    first = start + bounds[slot]
+                    last = start + bounds[slot + 1]
+                    flags[first:last] = b'\x01' * (last - first)
+                self.clear_maps([hits])
+            self.clear_hit_buffers()
+        return self.to_bits(flags)
+
+    def get_probe_bits(self, lines=(), codeobj_ids=()):
+        """Bitset of the probe ids on lines or in code objects."""
+        lines = set(lines)
+        flags = bytearray(len(self))
+        for codeobj_id, (start, stop) in self.code_rows.items():
+            if codeobj_id in codeobj_ids:
+                flags[start:stop] = b'\x01' * (stop - start)
+                continue
+            if not lines:
+                continue
+            line = None
+            for probe_id in range(start, stop):
+                line = self.lines[probe_id] or line
+                if line in lines:
+                    flags[probe_id] = 1
+        return self.to_bits(flags)
+
+    def make_buffer(self, name):
+        """A new map for ThreadBuffers, registered for merging."""
+        with self.lock:
+            if name == 'visited':
+                buffer = bytearray(len(self))
+                self.thread_visited.append(buffer)
+                return buffer
+            codeobj_id = int(name[len('hits_'):])
+            hits, _ = self.hits[codeobj_id]
+            buffer = Wrapper.make_hit_map(
+                len(hits), not isinstance(hits, bytearray))
+            self.thread_hits.setdefault(codeobj_id, []).append(buffer)
+            return buffer
+
+    def release_buffers(self, buffers):
+        """
+        Fold the maps of a thread that has ended into the shared ones and
+        drop them, so threads that come and go do not add up. The first
+        hit map of a code object that is released stays registered and
+        takes the hits of the next ones.
+        """
+        with self.lock:
+            for name, buffer in buffers.items():
+                if name == 'visited':
+                    size = len(buffer)
+                    merged = int.from_bytes(self.visited[:size], 'little')
+                    merged |= int.from_bytes(buffer, 'little')
+                    self.visited[:size] = merged.to_bytes(size, 'little')
+                    self.thread_visited[:] = [
+                        item for item in self.thread_visited
+                        if item is not buffer]
+                    continue
+                codeobj_id = int(name[len('hits_'):])
+                folded = self.folded_hits.get(codeobj_id)
+                if folded is None:
+                    self.folded_hits[codeobj_id] = buffer
+                    continue
+                if isinstance(buffer, bytearray):
+                    merged = int.from_bytes(folded, 'little')
+                    merged |= int.from_bytes(buffer, 'little')
+                    folded[:] = merged.to_bytes(len(folded), 'little')
+                else:
+                    for slot, hit in enumerate(buffer):
+                        folded[slot] += hit
+                self.thread_hits[codeobj_id] = [
+                    item for item in self.thread_hits[codeobj_id]
+                    if item is not buffer]
+
+    def merge(self):
+        """
+        Fold the per-thread maps into visited and the shared hit maps. Maps
+        are only added to, so merging again later is safe; threads that keep
+        running show up in the next merge.
+        """
+        with self.lock:
+            self.merge_visited(0, len(self.visited))
+            for codeobj_id in sorted(self.thread_hits):
+                self.merge_hits(codeobj_id)
+
+    def merge_visited(self, start, stop):
+        # rows start:stop of the thread visited maps; the lock is held
+        if not self.thread_visited:
             return
+        merged = int.from_bytes(self.visited[start:stop], 'little')
+        for buffer in self.thread_visited:
+            merged |= int.from_bytes(buffer[start:stop], 'little')
+        self.visited[start:stop] = merged.to_bytes(stop - start, 'little')
 
-        if self.opcodes[key].instruction == instruction:
-            self.opcodes[key].visit()
+    def merge_hits(self, codeobj_id):
+        # the thread hit maps of one code object; the lock is held
+        buffers = self.thread_hits.get(codeobj_id)
+        if not buffers:
             return
+        hits, _ = self.hits[codeobj_id]
+        if isinstance(hits, bytearray):
+            merged = 0
+            for buffer in buffers:
+                merged |= int.from_bytes(buffer, 'little')
+            hits[:] = merged.to_bytes(len(hits), 'little')
+        else:
+            for slot in range(len(hits)):
+                hits[slot] = sum(buffer[slot] for buffer in buffers)
 
-        raise Exception(
-            'Unexpected instruction {} {} {}'.format(
-                codeobj_id, offset, str(instruction))
-        )
+    def take_dirty(self):
+        """Ids of the code objects that ran since the last call."""
+        codeobj_ids = []
+        codeobj_id = self.dirty.find(1)
+        while codeobj_id != -1:
+            self.dirty[codeobj_id] = 0
+            codeobj_ids.append(codeobj_id)
+            codeobj_id = self.dirty.find(1, codeobj_id + 1)
+        return codeobj_ids
+
+    def keep_dirty(self, code_ids):
+        # frames that are still running record more hits without starting
+        # again, so their code objects stay dirty
+        for code_id in code_ids:
+            codeobj_id = self.instrumented_ids.get(code_id)
+            if codeobj_id is not None:
+                self.dirty[codeobj_id] = 1
+
+    def snapshot(self, codeobj_ids):
+        """
+        {probe_id: hits} recorded in the given code objects since their
+        previous snapshot; in trace and probe mode hits is 1 for every
+        probe that fired for the first time.
+        """
+        delta = {}
+        with self.lock:
+            for codeobj_id in codeobj_ids:
+                if codeobj_id not in self.code_rows:
+                    continue
+                start, stop = self.code_rows[codeobj_id]
+                if codeobj_id in self.hits:
+                    self.merge_hits(codeobj_id)
+                    hits, bounds = self.hits[codeobj_id]
+                    drained = self.drained.get(codeobj_id)
+                    if drained is not None and isinstance(hits, bytearray):
+                        # a probe that fired again after a drain is no news
+                        hits = [
+                            int(bool(hit or total))
+                            for hit, total in zip(hits, drained)]
+                    elif drained is not None:
+                        hits = [
+                            hit + total for hit, total in zip(hits, drained)]
+                else:
+                    # trace probes, one slot per row
+                    self.merge_visited(start, stop)
+                    bounds = range(stop - start + 1)
+                    hits = self.visited[start:stop]
+                # a bytearray would be taken as the raw bytes of the array
+                current = array('Q', list(hits))
+                previous = self.snapshots.get(codeobj_id)
+                self.snapshots[codeobj_id] = current
+                for slot, hit in enumerate(current):
+                    if previous is not None:
+                        hit -= previous[slot]
+                    if hit <= 0:
+                        continue
+                    for probe_id in range(
+                            start + bounds[slot], start + bounds[slot + 1]):
+                        delta[probe_id] = hit
+        return delta
+
+    def collect(self):
+        self.merge()
+
+        # functions that were never called are reported as fully missing
+        for codeobj_id, original in list(self.pending.items()):
+            if codeobj_id not in self.codes:
+                self.list_code(codeobj_id, original)
+            del self.pending[codeobj_id]
+
+        for codeobj_id, (hits, bounds) in list(self.hits.items()):
+            start = self.code_rows[codeobj_id][0]
+            counting = not isinstance(hits, bytearray)
+            if counting and self.counts is None:
+                self.counts = array('Q', [0]) * len(self)
+            drained = self.drained.get(codeobj_id)
+            if drained is not None:
+                hits = [hit + total for hit, total in zip(hits, drained)]
+            for slot, hit in enumerate(hits):
+                if not hit:
+                    continue
+                first, last = start + bounds[slot], start + bounds[slot + 1]
+                self.visited[first:last] = b'\x01' * (last - first)
+                if counting:
+                    for probe_id in range(first, last):
+                        self.counts[probe_id] = hit
+
+
+class ThreadBuffers(threading.local):
+    """
+    Per-thread hit maps of one module: `visited` for callback probes and
+    `hits_<codeobj_id>` for inline probes. The first read of a map in a
+    thread allocates that thread's own copy, so recording never writes to
+    memory shared with other threads. Once the thread has ended, its copies
+    are folded into the shared maps and dropped.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        maps = self.__dict__.get('maps')
+        if maps is None:
+            # the owner goes away with this thread's attributes
+            self.owner = ThreadOwner()
+            maps = self.maps = {}
+            finalizer = weakref.finalize(
+                self.owner, self.data.release_buffers, maps)
+            finalizer.atexit = False
+        buffer = self.data.make_buffer(name)
+        maps[name] = buffer
+        setattr(self, name, buffer)
+        return buffer
+
+
+class ThreadOwner:
+    """Stands for a thread in ThreadBuffers, see weakref.finalize."""
+
+    __slots__ = ('__weakref__',)
 
 
 class WrappedOpcode:
-    def __init__(self, instruction):
-        self.instruction = instruction
-        self.visited = False
+    """Read-only view of one FileOpcode row, built for reporting."""
+
+    __slots__ = ('data', 'probe_id')
+
+    def __init__(self, data, probe_id):
+        self.data = data
+        self.probe_id = probe_id
+
+    @property
+    def codeobj_id(self):
+        return self.data.codeobj_ids[self.probe_id]
+
+    @property
+    def offset(self):
+        return self.data.offsets[self.probe_id]
+
+    @property
+    def opcode(self):
+        return self.data.ops[self.probe_id]
+
+    @property
+    def opname(self):
+        return opname[self.opcode]
+
+    @property
+    def arg(self):
+        arg = self.data.args[self.probe_id]
+        return None if arg < 0 else arg
+
+    @property
+    def argrepr(self):
+        return self.data.strings[self.data.argreprs[self.probe_id]]
+
+    @property
+    def starts_line(self):
+        return self.data.lines[self.probe_id] or None
+
+    @property
+    def is_jump_target(self):
+        return bool(self.data.jump_targets[self.probe_id])
 
-    def __getattr__(self, item):
-        return getattr(self.instruction, item)
+    @property
+    def visited(self):
+        return bool(self.data.visited[self.probe_id])
 
-    def visit(self):
-        self.visited = True
+    @property
+    def count(self):
+        if self.data.counts is None:
+            # without counters of its own a visited opcode counts once,
+            # unless the counters all come from other processes
+            count = 0 if self.data.merged_counts else (
+                self.data.visited[self.probe_id])
+        else:
+            count = self.data.counts[self.probe_id]
+        return count + self.data.merged_counts.get(self.probe_id, 0)
 
     def __str__(self):
-        return '{} {}'.format(
-            '[visited]' if self.visited else '[missing]', self.instruction
+        return (
+            '{} Instruction(opname={!r}, opcode={}, arg={!r}, argrepr={!r}, '
+            'offset={}, starts_line={!r}, is_jump_target={!r})'
+        ).format(
+            '[visited]' if self.visited else '[missing]', self.opname,
+            self.opcode, self.arg, self.argrepr, self.offset,
+            self.starts_line, self.is_jump_target,
         )
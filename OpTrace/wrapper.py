@@ -1,15 +1,72 @@
 import opcode
 import dis
+import inspect
+import sys
+import threading
 
-from types import CodeType
-from functools import partial
+from array import array
+from inspect import (
+    CO_NEWLOCALS, CO_VARARGS, CO_VARKEYWORDS, CO_GENERATOR, CO_COROUTINE,
+    CO_ITERABLE_COROUTINE,
+)
+from types import CodeType, FunctionType
+
+from OpTrace.opcode_resolver import OpcodeResolver
+from OpTrace.walker import iter_functions
 
 class Wrapper:
     AGR_OP_LEN = 3
+    GRANULARITIES = ('opcode', 'line', 'branch', 'block')
+
+    # Opcodes the reporter has nothing to show for get no row and no probe;
+    # SETUP_WITH is listed but still resolved to its `with`. The rest are
+    # their counterparts in the bytecode of later Pythons, which only the
+    # monitoring engine sees.
+    UNREPORTED = frozenset(OpcodeResolver.skip_opnames).difference(
+        OpcodeResolver.SYMBOLS).union((
+            'RESUME', 'CACHE', 'PUSH_NULL', 'COPY', 'SWAP', 'KW_NAMES',
+            'PRECALL', 'TO_BOOL', 'END_FOR', 'END_SEND', 'NOT_TAKEN',
+            'POP_ITER', 'RETURN_GENERATOR', 'COPY_FREE_VARS', 'MAKE_CELL',
+        ))
+
+    # dis of Python 3.13+ has a flag in starts_line and the line apart
+    LINE_NUMBERS = 'line_number' in dis.Instruction._fields
+
+    # After these the next instruction starts a new basic block even though
+    # they do not jump: control leaves the frame or may never come back.
+    BLOCK_TERMINATORS = frozenset(
+        opcode.opmap[name]
+        for name in (
+            'RETURN_VALUE', 'RAISE_VARARGS', 'BREAK_LOOP', 'END_FINALLY',
+            'YIELD_VALUE', 'YIELD_FROM', 'RETURN_CONST', 'RERAISE',
+        )
+        if name in opcode.opmap
+    )
 
-    def __init__(self, trace_func, mark_func):
+    # A generator frame resumes right after these
+    RESUMES = frozenset(
+        opcode.opmap[name]
+        for name in ('YIELD_VALUE', 'YIELD_FROM')
+        if name in opcode.opmap
+    )
+
+    def __init__(self, trace_func, mark_func, hits_func=None,
+                 granularity='opcode', code_func=None, counters=False,
+                 buffers=None, dirty=None):
+        if granularity not in self.GRANULARITIES:
+            raise ValueError('Unknown granularity {!r}, expected one of {}'.format(
+                granularity, ', '.join(self.GRANULARITIES)))
         self.visit = trace_func
         self.mark = mark_func
+        self.add_hits = hits_func
+        self.add_code = code_func
+        self.counters = counters
+        # per-thread hit maps, read as buffers.hits_<codeobj_id>
+        self.buffers = buffers
+        # dirty[codeobj_id] = 1 whenever a frame of the code object starts
+        # or resumes, so snapshots only read what ran since the last one
+        self.dirty = dirty
+        self.granularity = granularity
         self.current_code_object_id = 0
 
     def print_codeobj_attr(self, obj):
@@ -34,83 +91,544 @@ class Wrapper:
             print(opcode.opname[code])
 
     @property
-    def TRACE_CODE_LEN(self):
-        return len(list(self.make_trace(0)))
+    def probe_mode(self):
+        return self.add_hits is not None
+
+    @property
+    def stack_increase(self):
+        # counters[slot] += 1 needs four stack items, the rest three at most
+        return 4 if self.probe_mode and self.counters else self.AGR_OP_LEN
+
+    @staticmethod
+    def make_hit_map(size, counters=False):
+        if counters:
+            return array('Q', [0]) * size
+        return bytearray(size)
 
     def make_args(self, value):
         yield from reversed(divmod(value, 256))
 
+    def make_instruction(self, op, arg=None, wide=False):
+        if op < opcode.HAVE_ARGUMENT:
+            yield op
+            return
+        if wide or arg > 0xFFFF:
+            yield opcode.EXTENDED_ARG
+            yield from self.make_args(arg >> 16)
+        yield op
+        yield from self.make_args(arg & 0xFFFF)
+
+    def instruction_len(self, op, arg):
+        if op < opcode.HAVE_ARGUMENT:
+            return 1
+        return self.AGR_OP_LEN * (2 if arg > 0xFFFF else 1)
+
     def make_trace(self, constant_index):
-        yield opcode.opmap['LOAD_CONST']
-        yield from self.make_args(constant_index)
-        yield opcode.opmap['CALL_FUNCTION']
-        yield from [0, 0] # trace_func parameters set by closure in lambda
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], constant_index)
+        yield from self.make_instruction(opcode.opmap['CALL_FUNCTION'], 0)
+        # trace_func parameters set by closure in lambda
         yield opcode.opmap['POP_TOP']
 
-    def calculate_offset(self, old_offset, code):
-        new_position = self.TRACE_CODE_LEN-1
-        skip_args_counter = 0
-        for op in code[:old_offset + 1]:
-            if skip_args_counter:
-                skip_args_counter -= 1
-                new_position += 1
+    def make_load_hits(self, hits_index, name_index=None):
+        # either the hit map itself or the thread buffers holding it
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], hits_index)
+        if name_index is not None:
+            yield from self.make_instruction(opcode.opmap['LOAD_ATTR'], name_index)
+
+    def make_probe(self, value_index, hits_index, slot_index, name_index=None):
+        # hits[slot] = 1 -- a plain STORE_SUBSCR, no Python-level call
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], value_index)
+        yield from self.make_load_hits(hits_index, name_index)
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], slot_index)
+        yield opcode.opmap['STORE_SUBSCR']
+
+    def make_counter(self, value_index, hits_index, slot_index, name_index=None):
+        # hits[slot] += 1 -- the same, reading the old value first
+        yield from self.make_load_hits(hits_index, name_index)
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], slot_index)
+        yield opcode.opmap['DUP_TOP_TWO']
+        yield opcode.opmap['BINARY_SUBSCR']
+        yield from self.make_instruction(opcode.opmap['LOAD_CONST'], value_index)
+        yield opcode.opmap['INPLACE_ADD']
+        yield opcode.opmap['ROT_THREE']
+        yield opcode.opmap['STORE_SUBSCR']
+
+    @staticmethod
+    def get_instructions(codeobj):
+        # EXTENDED_ARG is folded into the next instruction's arg by dis and
+        # re-emitted by make_instruction when still needed. Jumps may target
+        # the prefix, so remember where each instruction really starts, and
+        # the line the prefix starts.
+        start = line = None
+        for st in dis.get_instructions(codeobj):
+            if Wrapper.LINE_NUMBERS:
+                st = st._replace(
+                    starts_line=st.line_number if st.starts_line else None)
+            if st.opcode == opcode.EXTENDED_ARG:
+                if start is None:
+                    start, line = st.offset, st.starts_line
                 continue
+            if line is not None and st.starts_line is None:
+                st = st._replace(starts_line=line)
+            yield (st.offset if start is None else start), st
+            start = line = None
+
+    @staticmethod
+    def get_jump_target(st):
+        if st.opcode in opcode.hasjrel:
+            return st.argval
+        if st.opcode in opcode.hasjabs:
+            return st.arg
+        return None
+
+    def make_blocks(self, instructions):
+        """
+        Group instructions into the units that get one probe each, placed
+        before the first instruction of the unit:
+
+        opcode  every instruction
+        line    the instructions from one line start to the next
+        branch  jumps, their targets and the instructions right after
+                them, so both outcomes of a conditional jump are seen;
+                nothing else is probed
+        block   basic blocks: a block starts at the first instruction, at
+                every jump target and right after a jump or a terminator,
+                so all of its instructions run together
+        """
+        if self.granularity == 'opcode':
+            return [[item] for item in instructions]
+        if self.granularity == 'branch':
+            return self.make_branches(instructions)
+
+        leaders = {instructions[0][0]}
+        for index, (start, st) in enumerate(instructions):
+            if self.granularity == 'line':
+                if st.starts_line is not None:
+                    leaders.add(start)
+                continue
+            target = self.get_jump_target(st)
+            if target is not None:
+                leaders.add(target)
+            elif st.opcode not in self.BLOCK_TERMINATORS:
+                continue
+            if index + 1 < len(instructions):
+                leaders.add(instructions[index + 1][0])
+
+        blocks = []
+        for start, st in instructions:
+            if start in leaders or st.offset in leaders:
+                blocks.append([])
+            blocks[-1].append((start, st))
+        return blocks
+
+    def make_branches(self, instructions):
+        anchors = set()
+        for index, (start, st) in enumerate(instructions):
+            target = self.get_jump_target(st)
+            if target is None:
+                continue
+            anchors.update((start, target))
+            if index + 1 < len(instructions):
+                anchors.add(instructions[index + 1][0])
+
+        # a probe on an unreported opcode, such as the POP_BLOCK a loop
+        # exits to, stands for the next opcode that has a row
+        blocks = []
+        block = None
+        for start, st in instructions:
+            if start in anchors or st.offset in anchors:
+                block = [(start, st)]
+                blocks.append(block)
+            elif block is not None:
+                block.append((start, st))
+            if (st.opname not in self.UNREPORTED
+                    or st.opcode in self.BLOCK_TERMINATORS
+                    or self.get_jump_target(st) is not None):
+                block = None
+        return blocks
+
+    def get_rows(self, instructions, blocks):
+        """
+        The instructions of each block that get a row, those the reporter
+        can show. Rows only record the line an instruction starts, so the
+        first row of a line takes it over from unreported or unprobed
+        instructions that started it.
+        """
+        reported = {
+            start for block in blocks for start, st in block
+            if st.opname not in self.UNREPORTED
+        }
+        rows = {}
+        line = row_line = None
+        for start, st in instructions:
+            if st.starts_line is not None:
+                line = st.starts_line
+            if start not in reported:
+                continue
+            if line != row_line and st.starts_line is None:
+                st = st._replace(starts_line=line)
+            rows[start] = st
+            row_line = line
+        return [
+            [rows[start] for start, _ in block if start in rows]
+            for block in blocks
+        ]
+
+    def mark_blocks(self, codeobj_id, instructions):
+        """
+        The (instructions, rows) of every block that has rows, the probe
+        ids of those rows and the hit map of the code object, None in trace
+        mode. mark returns the probe id of each row; the rows of a block
+        are consecutive, so a slot of the hit map covers a range of them.
+        """
+        blocks = self.make_blocks(instructions)
+        blocks = [
+            (block, rows)
+            for block, rows in zip(blocks, self.get_rows(instructions, blocks))
+            if rows
+        ]
+        probe_ids = [
+            [self.mark(codeobj_id, st) for st in rows] for _, rows in blocks
+        ]
+        hits = None
+        if self.probe_mode:
+            hits = self.make_hit_map(len(blocks), self.counters)
+            bounds = [0]
+            for _, rows in blocks:
+                bounds.append(bounds[-1] + len(rows))
+            # code without rows, such as code without jumps in branch
+            # granularity, has nothing for FileOpcode to read
+            if blocks:
+                self.add_hits(codeobj_id, hits, bounds)
+        return blocks, probe_ids, hits
+
+    def add_dirty(self, codeobj_id):
+        if len(self.dirty) <= codeobj_id:
+            self.dirty.extend(bytes(codeobj_id + 1 - len(self.dirty)))
+
+    def make_block_visitor(self, probe_ids):
+        def visit():
+            for probe_id in probe_ids:
+                self.visit(probe_id)
+        return visit
+
+    def relocate(self, instructions, probes):
+        """
+        Build the old offset -> new offset table in one pass over the code.
+        Jump args depend on the table and may in turn need EXTENDED_ARG, so
+        the pass is repeated only while some jump has grown (lengths never
+        shrink, so this ends quickly and usually after the first pass).
+        """
+        lengths = [
+            len(probe) + self.instruction_len(st.opcode, st.arg)
+            for (_, st), probe in zip(instructions, probes)
+        ]
+        args = [st.arg for _, st in instructions]
+        while True:
+            new_offsets = {}
+            position = 0
+            for (start, st), length in zip(instructions, lengths):
+                new_offsets[start] = new_offsets[st.offset] = position
+                position += length
 
-            if op >= opcode.HAVE_ARGUMENT:
-                skip_args_counter = 2
+            grown = False
+            for index, (start, st) in enumerate(instructions):
+                if st.opcode in opcode.hasjrel:
+                    args[index] = new_offsets[st.argval] - (
+                        new_offsets[start] + lengths[index])
+                elif st.opcode in opcode.hasjabs:
+                    args[index] = new_offsets[st.arg]
+                else:
+                    continue
+                length = len(probes[index]) + self.instruction_len(
+                    st.opcode, args[index])
+                if length > lengths[index]:
+                    lengths[index] = length
+                    grown = True
 
-            new_position += self.TRACE_CODE_LEN + 1
+            if not grown:
+                return new_offsets, args, lengths
 
-        return new_position
+    def assemble(self, instructions, probes):
+        """
+        The code with every probe put before its instruction, and the old
+        offset -> new offset table.
+        """
+        new_offsets, args, lengths = self.relocate(instructions, probes)
+        codes = bytearray()
+        for (_, st), probe, arg, length in zip(instructions, probes, args, lengths):
+            codes.extend(probe)
+            codes.extend(self.make_instruction(
+                st.opcode, arg,
+                wide=length - len(probe) > self.AGR_OP_LEN
+            ))
+        return bytes(codes), new_offsets
+
+    def make_lnotab(self, firstlineno, line_starts, new_offsets):
+        # line_starts are the (offset, line) pairs of dis.findlinestarts
+        lnotab = []
+        last_offset, last_line = 0, firstlineno
+        for offset, line in line_starts:
+            offset_delta = new_offsets[offset] - last_offset
+            line_delta = line - last_line
+            while offset_delta > 255:
+                lnotab.extend((255, 0))
+                offset_delta -= 255
+            while line_delta > 255:
+                lnotab.extend((offset_delta, 255))
+                offset_delta, line_delta = 0, line_delta - 255
+            if offset_delta or line_delta:
+                lnotab.extend((offset_delta, line_delta))
+            last_offset, last_line = new_offsets[offset], line
+        return bytes(lnotab)
+
+    @staticmethod
+    def copy_code(codeobj, **changes):
+        return CodeType(*(
+            changes.get(name, getattr(codeobj, name))
+            for name in (
+                'co_argcount', 'co_kwonlyargcount', 'co_nlocals',
+                'co_stacksize', 'co_flags', 'co_code', 'co_consts',
+                'co_names', 'co_varnames', 'co_filename', 'co_name',
+                'co_firstlineno', 'co_lnotab', 'co_freevars', 'co_cellvars',
+            )
+        ))
 
     def get_codeobj_id(self):
         self.current_code_object_id += 1
         return self.current_code_object_id
 
+    def wrap_nested(self, codeobj, parent_id):
+        return self.wrap_code(codeobj, self.get_codeobj_id())
+
     def wrap_code(self, codeobj, codeobj_id=0):
-        codes = []
         constants = [
-            self.wrap_code(item, self.get_codeobj_id())
+            self.wrap_nested(item, codeobj_id)
             if isinstance(item, CodeType) else item
             for item in codeobj.co_consts
         ]
+        instructions = list(self.get_instructions(codeobj))
+        blocks, probe_ids, hits = self.mark_blocks(codeobj_id, instructions)
+        names, name_index = codeobj.co_names, None
+        if self.probe_mode:
+            if self.buffers is None:
+                constants.extend([1, hits])
+            else:
+                constants.extend([1, self.buffers])
+                names += ('hits_{}'.format(codeobj_id),)
+                name_index = len(names) - 1
+            value_index, hits_index = len(constants) - 2, len(constants) - 1
 
-        update_offset = partial(self.calculate_offset, code=codeobj.co_code)
-        for st in dis.get_instructions(codeobj):
-            self.mark(codeobj_id, st)
-            constants.append(
-                lambda co_id=codeobj_id, opcode=st: self.visit(co_id, opcode)
-            )
-            codes.extend(self.make_trace(len(constants) - 1))
-            codes.append(st.opcode)
-
-            if st.opcode in opcode.hasjrel:
-                current_position = update_offset(st.offset)
-                taget_position = update_offset(st.argval) - self.TRACE_CODE_LEN - self.TRACE_CODE_LEN
-                new_delta = taget_position - current_position
-                codes.extend(self.make_args(new_delta - self.AGR_OP_LEN))
-            elif st.opcode in opcode.hasjabs:
-                codes.extend(self.make_args(
-                    update_offset(st.arg) - self.TRACE_CODE_LEN - self.TRACE_CODE_LEN
-                ))
-            elif st.opcode >= opcode.HAVE_ARGUMENT:
-                codes.extend(self.make_args(st.arg))
-
-        new_code = CodeType(
-            codeobj.co_argcount,
-            codeobj.co_kwonlyargcount,
-            codeobj.co_nlocals,
-            codeobj.co_stacksize + self.AGR_OP_LEN,
-            codeobj.co_flags,
-            bytes(codes),  # codestring
-            tuple(constants),  # constants
-            codeobj.co_names,
-            codeobj.co_varnames,
-            codeobj.co_filename,
-            codeobj.co_name,
-            codeobj.co_firstlineno,
-            codeobj.co_lnotab,
-            codeobj.co_freevars,
-            codeobj.co_cellvars,
+        make_probe = self.make_counter if self.counters else self.make_probe
+        probes = {}
+        for slot, (block, rows) in enumerate(blocks):
+            start = block[0][0]
+            if self.probe_mode:
+                constants.append(slot)
+                probes[start] = bytes(make_probe(
+                    value_index, hits_index, len(constants) - 1, name_index))
+            elif len(rows) == 1:
+                constants.append(
+                    lambda probe_id=probe_ids[slot][0]: self.visit(probe_id)
+                )
+                probes[start] = bytes(self.make_trace(len(constants) - 1))
+            else:
+                constants.append(self.make_block_visitor(probe_ids[slot]))
+                probes[start] = bytes(self.make_trace(len(constants) - 1))
+        probes = [probes.get(start, b'') for start, _ in instructions]
+
+        if self.dirty is not None:
+            self.add_dirty(codeobj_id)
+            constants.extend([1, self.dirty, codeobj_id])
+            mark = bytes(self.make_probe(
+                len(constants) - 3, len(constants) - 2, len(constants) - 1))
+            previous = None
+            for index, (_, st) in enumerate(instructions):
+                if previous is None or previous.opcode in self.RESUMES:
+                    probes[index] = mark + probes[index]
+                previous = st
+
+        codes, new_offsets = self.assemble(instructions, probes)
+        new_code = self.copy_code(
+            codeobj,
+            co_stacksize=codeobj.co_stacksize + self.stack_increase,
+            co_code=codes,
+            co_consts=tuple(constants),
+            co_names=names,
+            co_lnotab=self.make_lnotab(
+                codeobj.co_firstlineno, dis.findlinestarts(codeobj),
+                new_offsets),
         )
+        if self.add_code is not None:
+            self.add_code(codeobj_id, codeobj, new_code)
         return new_code
+
+
+class LazyWrapper(Wrapper):
+    """
+    Instruments module and class body code and generator and coroutine
+    functions right away, but every other function body only when it is
+    called for the first time. Until then the function
+    runs a small stub with the same signature, which instruments the body,
+    points the functions of the module at the new code and forwards the
+    call, so the first call is traced as well. Ids of the nested code
+    objects are the same as with Wrapper.
+    """
+
+    # asynchronous generators are 3.6+
+    EAGER_FLAGS = (
+        CO_GENERATOR | CO_COROUTINE | CO_ITERABLE_COROUTINE |
+        getattr(inspect, 'CO_ASYNC_GENERATOR', 0)
+    )
+
+    def __init__(self, *args, pending_func=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_pending = pending_func
+        self.lock = threading.RLock()
+        self.codes = {}
+        self.originals = {}
+        self.parents = {}
+        self.pending = {}
+        self.stubs = {}
+
+    def count_codes(self, codeobj):
+        return 1 + sum(
+            self.count_codes(item)
+            for item in codeobj.co_consts
+            if isinstance(item, CodeType)
+        )
+
+    def wrap_nested(self, codeobj, parent_id):
+        codeobj_id = self.get_codeobj_id()
+        self.parents[codeobj_id] = parent_id
+        if not codeobj.co_flags & CO_NEWLOCALS:
+            # a class body runs with the class namespace as its locals, so
+            # it cannot be forwarded through a call; it only runs once anyway
+            return self.wrap_code(codeobj, codeobj_id)
+        if codeobj.co_flags & self.EAGER_FLAGS:
+            # inspect, asyncio and pytest tell generator and coroutine
+            # functions apart by these flags before the first call, so a
+            # plain stub would not do
+            return self.wrap_code(codeobj, codeobj_id)
+
+        # ids of everything nested in it are handed out when it is wrapped
+        self.current_code_object_id += self.count_codes(codeobj) - 1
+        stub = self.make_stub(codeobj, codeobj_id)
+        self.pending[codeobj_id] = codeobj
+        self.stubs[codeobj_id] = stub
+        if self.add_pending is not None:
+            self.add_pending(codeobj_id, codeobj, stub)
+        return stub
+
+    def wrap_code(self, codeobj, codeobj_id=0):
+        new_code = super().wrap_code(codeobj, codeobj_id)
+        self.codes[codeobj_id] = new_code
+        self.originals[codeobj_id] = codeobj
+        return new_code
+
+    def make_stub(self, codeobj, codeobj_id):
+        """
+        return load_function(codeobj_id, <closure>)(<every argument>)
+
+        Arguments that are also cell variables have already been moved into
+        their cells when the stub starts, so those are read with LOAD_DEREF.
+        """
+        names = codeobj.co_varnames
+        argcount = codeobj.co_argcount
+        kwonlycount = codeobj.co_kwonlyargcount
+        # co_consts[0] stays first: it is where functions take __doc__ from
+        constants = [
+            codeobj.co_consts[0] if codeobj.co_consts else None,
+            self.load_function, codeobj_id, None,
+        ]
+        make = self.make_instruction
+        codes = []
+        codes.extend(make(opcode.opmap['LOAD_CONST'], 1))
+        codes.extend(make(opcode.opmap['LOAD_CONST'], 2))
+        if codeobj.co_freevars:
+            cells = len(codeobj.co_cellvars)
+            for index in range(len(codeobj.co_freevars)):
+                codes.extend(make(opcode.opmap['LOAD_CLOSURE'], cells + index))
+            codes.extend(make(
+                opcode.opmap['BUILD_TUPLE'], len(codeobj.co_freevars)))
+        else:
+            codes.extend(make(opcode.opmap['LOAD_CONST'], 3))
+        codes.extend(make(opcode.opmap['CALL_FUNCTION'], 2))
+
+        def load(name):
+            if name in codeobj.co_cellvars:
+                return make(
+                    opcode.opmap['LOAD_DEREF'], codeobj.co_cellvars.index(name))
+            return make(opcode.opmap['LOAD_FAST'], names.index(name))
+
+        for name in names[:argcount]:
+            codes.extend(load(name))
+        for name in names[argcount:argcount + kwonlycount]:
+            constants.append(name)
+            codes.extend(make(opcode.opmap['LOAD_CONST'], len(constants) - 1))
+            codes.extend(load(name))
+
+        call = 'CALL_FUNCTION'
+        index = argcount + kwonlycount
+        if codeobj.co_flags & CO_VARARGS:
+            codes.extend(load(names[index]))
+            index += 1
+            call = 'CALL_FUNCTION_VAR'
+        if codeobj.co_flags & CO_VARKEYWORDS:
+            codes.extend(load(names[index]))
+            call = 'CALL_FUNCTION_VAR_KW' if call == 'CALL_FUNCTION_VAR' \
+                else 'CALL_FUNCTION_KW'
+        codes.extend(make(opcode.opmap[call], argcount | kwonlycount << 8))
+        codes.append(opcode.opmap['RETURN_VALUE'])
+
+        return self.copy_code(
+            codeobj,
+            co_stacksize=max(
+                2 + max(len(codeobj.co_freevars), 1),
+                1 + argcount + 2 * kwonlycount + 2,
+            ),
+            co_code=bytes(codes),
+            co_consts=tuple(constants),
+            co_names=(),
+            co_lnotab=b'',
+        )
+
+    def load_function(self, codeobj_id, closure):
+        namespace = sys._getframe(1).f_globals
+        code = self.instrument(codeobj_id, namespace)
+        return FunctionType(code, namespace, code.co_name, None, closure)
+
+    def instrument(self, codeobj_id, namespace):
+        code = self.codes.get(codeobj_id)
+        if code is not None:
+            return code
+        with self.lock:
+            if codeobj_id not in self.codes:
+                self.current_code_object_id = codeobj_id
+                self.wrap_code(self.pending.pop(codeobj_id), codeobj_id)
+                self.relink(codeobj_id, self.stubs.pop(codeobj_id), namespace)
+            return self.codes[codeobj_id]
+
+    def relink(self, codeobj_id, old, namespace):
+        """
+        Point functions that still use `old` at the current code, and give
+        the parent code object a copy of its constants that has it too, so
+        closures created from now on start instrumented.
+        """
+        new = self.codes[codeobj_id]
+        for function in iter_functions(namespace):
+            if function.__code__ is old:
+                function.__code__ = new
+
+        parent_id = self.parents.get(codeobj_id)
+        if not parent_id:
+            # module code has already run
+            return
+        parent = self.codes[parent_id]
+        self.codes[parent_id] = self.copy_code(parent, co_consts=tuple(
+            new if item is old else item for item in parent.co_consts
+        ))
+        if self.add_code is not None:
+            self.add_code(
+                parent_id, self.originals[parent_id], self.codes[parent_id])
+        self.relink(parent_id, parent, namespace)
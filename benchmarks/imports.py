@@ -0,0 +1,74 @@
+"""
+Import time of modules the hook does not target.
+
+Generates --modules small modules and imports all of them without a hook,
+then with a hook set up for some other module, several times each; with
+the hook only looking at specs of non-targets the two should match.
+
+    python -m benchmarks.imports --modules 500 --repeat 5
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+from OpTrace.hook import OpTraceHook
+
+
+TARGET = '''
+import os
+
+
+def value(size):
+    return [os.sep * i for i in range(size)]
+'''
+
+
+def import_all(names):
+    for name in names:
+        sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    start = time.perf_counter()
+    for name in names:
+        importlib.import_module(name)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modules', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='optrace-bench-')
+    names = ['optrace_bench_import_{}'.format(i) for i in range(args.modules)]
+    for name in names:
+        with open(os.path.join(directory, name + '.py'), 'w') as file:
+            file.write(TARGET)
+    sys.path.insert(0, directory)
+    # compile once, both variants then load the same cached bytecode
+    import_all(names)
+
+    hook = OpTraceHook(['optrace_bench_import_target'], mode='probe')
+    plain = []
+    hooked = []
+    for _ in range(args.repeat):
+        plain.append(import_all(names))
+        hook.setup_hook()
+        try:
+            hooked.append(import_all(names))
+        finally:
+            hook.teardown_hook()
+
+    plain, hooked = min(plain), min(hooked)
+    print('{} modules, best of {}'.format(args.modules, args.repeat))
+    print('{: >8} {: >10.1f}us per import'.format(
+        'plain', plain / args.modules * 1e6))
+    print('{: >8} {: >10.1f}us per import {: >6.2f}x'.format(
+        'hooked', hooked / args.modules * 1e6, hooked / plain))
+
+
+if __name__ == '__main__':
+    main()
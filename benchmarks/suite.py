@@ -0,0 +1,236 @@
+"""
+Cost of OpTrace on synthetic modules of growing size.
+
+For every size a module of loops, branches, comprehensions, closures,
+classes and big functions is generated, then the suite measures:
+
+  - wrap_seconds: Wrapper.wrap_code of the whole module
+  - memory_bytes / memory_peak_bytes: memory held after wrapping (the
+    FileOpcode rows and the instrumented code) and its peak while wrapping
+  - plain_seconds / instrumented_seconds / slowdown: calls of run() on the
+    plain and on the instrumented import
+  - report_seconds: CommonReporter over the collected data
+
+and writes the results as JSON, so runs can be compared.
+
+    python -m benchmarks.suite --lines 1000 10000 100000 -o results.json
+    python -m benchmarks.suite --engine monitoring
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from OpTrace import __version__
+from OpTrace.hook import OpTraceHook
+from OpTrace.reporter import CommonReporter
+from OpTrace.wrapper import Wrapper
+
+from benchmarks.threads import DEFAULT_ENGINE, load_target
+
+
+BLOCKS = [
+    ('loop_{n}', '''
+def loop_{n}(size):
+    total = 0
+    for i in range(size):
+        if i % 3 == 0:
+            total += i
+        elif i % 3 == 1:
+            total -= 1
+        else:
+            continue
+    while total > 10:
+        total //= 2
+    return total
+'''),
+    ('comprehension_{n}', '''
+def comprehension_{n}(size):
+    squares = [i * i for i in range(size) if i % 2]
+    names = {{i: str(i) for i in range(size)}}
+    return sum(squares) + len(names) + sum(i for i in squares if i > 10)
+'''),
+    ('closure_{n}', '''
+def closure_{n}(size):
+    offset = size // 2
+
+    def inner(value, scale=2):
+        return (value + offset) * scale
+    return sum(map(inner, range(size))) + (lambda x: x - offset)(size)
+'''),
+    ('shape_{n}', '''
+class Shape_{n}:
+    sides = {n} % 7
+
+    def __init__(self, size):
+        self.size = size
+
+    def area(self):
+        if self.sides < 3:
+            return 0
+        return self.size * self.sides
+
+    @property
+    def name(self):
+        return 'shape_{n}' if self.sides else None
+
+
+def shape_{n}(size):
+    shape = Shape_{n}(size)
+    try:
+        return shape.area() + len(shape.name or '')
+    except ZeroDivisionError:
+        return -1
+'''),
+]
+BIG_STATEMENTS = 100
+
+
+def make_big_function(n):
+    # one long code object, the worst case for per-function work
+    lines = ['', 'def big_{}(size):'.format(n), '    value = size']
+    for i in range(BIG_STATEMENTS // 4):
+        lines.extend([
+            '    if value % {} == 0:'.format(i % 7 + 2),
+            '        value += {}'.format(i),
+            '    else:',
+            '        value = (value * 3 + {}) % 1000003'.format(i),
+        ])
+    lines.append('    return value')
+    return 'big_{}'.format(n), '\n'.join(lines) + '\n'
+
+
+def generate_module(size):
+    """Source of a module of about `size` lines with a run(size) entry."""
+    parts = []
+    entries = []
+    lines = 0
+    n = 0
+    while lines < size:
+        if n % (len(BLOCKS) + 1) == len(BLOCKS):
+            name, text = make_big_function(n)
+        else:
+            name, block = BLOCKS[n % (len(BLOCKS) + 1)]
+            name, text = name.format(n=n), block.format(n=n)
+        parts.append(text)
+        entries.append(name)
+        lines += text.count('\n')
+        n += 1
+    parts.append('\n\nENTRIES = [\n{}]\n'.format(
+        ''.join('    {},\n'.format(name) for name in entries)))
+    parts.append('''
+
+def run(size):
+    total = 0
+    for func in ENTRIES:
+        total += func(size)
+    return total
+''')
+    return ''.join(parts)
+
+
+def time_calls(func, calls, size):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func(size)
+    return time.perf_counter() - start
+
+
+def measure(directory, lines, args):
+    name = 'optrace_bench_{}'.format(lines)
+    source = generate_module(lines)
+    path = os.path.join(directory, name + '.py')
+    with open(path, 'w') as file:
+        file.write(source)
+    options = dict(
+        mode=args.mode, granularity=args.granularity, engine=args.engine)
+
+    code = compile(source, path, 'exec')
+    hook = OpTraceHook([name], **options)
+    tracemalloc.start()
+    start = time.perf_counter()
+    wrapper = hook.make_wrapper(name, source.splitlines())
+    wrapped = wrapper.wrap_code(code)
+    wrap_seconds = time.perf_counter() - start
+    memory, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    opcodes = len(hook.module_opcodes[name])
+    del wrapper, wrapped, hook
+
+    plain = load_target(name).run
+    hook = OpTraceHook([name], **options)
+    instrumented = load_target(name, hook).run
+    plain_seconds = time_calls(plain, args.calls, args.size)
+    instrumented_seconds = time_calls(instrumented, args.calls, args.size)
+    hook.teardown_hook()
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            CommonReporter(hook.module_opcodes, args.workers).report()
+    report_seconds = time.perf_counter() - start
+
+    return dict(
+        lines=source.count('\n'),
+        opcodes=opcodes,
+        wrap_seconds=wrap_seconds,
+        memory_bytes=memory,
+        memory_peak_bytes=memory_peak,
+        plain_seconds=plain_seconds,
+        instrumented_seconds=instrumented_seconds,
+        slowdown=instrumented_seconds / plain_seconds,
+        report_seconds=report_seconds,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--mode', default='probe', choices=OpTraceHook.MODES)
+    parser.add_argument('--engine', default=DEFAULT_ENGINE,
+                        choices=OpTraceHook.ENGINES)
+    parser.add_argument('--granularity', default='opcode',
+                        choices=Wrapper.GRANULARITIES)
+    parser.add_argument('--calls', type=int, default=5)
+    parser.add_argument('--size', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('-o', '--output', default='-',
+                        help='file to write, - for stdout')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='optrace-bench-')
+    sys.path.insert(0, directory)
+    results = []
+    for lines in args.lines:
+        result = measure(directory, lines, args)
+        print('{lines: >8} lines {wrap_seconds: >8.3f}s wrap '
+              '{slowdown: >6.2f}x run {report_seconds: >8.3f}s report'
+              .format(**result), file=sys.stderr)
+        results.append(result)
+
+    output = dict(
+        version=__version__,
+        python=platform.python_version(),
+        mode=args.mode,
+        engine=args.engine,
+        granularity=args.granularity,
+        calls=args.calls,
+        size=args.size,
+        results=results,
+    )
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
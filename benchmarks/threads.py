@@ -0,0 +1,121 @@
+"""
+Overhead of the hook with several threads running instrumented code.
+
+Every thread runs the same loop the same number of times, so with a flat
+overhead the instrumented/plain ratio stays the same as threads are added.
+Compares shared hit maps with thread_buffers=True; the monitoring engine
+has no thread buffers and only runs the shared variant.
+
+    python -m benchmarks.threads --mode probe --threads 1 2 4 8
+    python -m benchmarks.threads --engine monitoring
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from OpTrace.hook import OpTraceHook
+
+
+# the rewrite engine instruments 3.5 bytecode, later Pythons need monitoring
+DEFAULT_ENGINE = 'monitoring' if sys.version_info >= (3, 12) else 'rewrite'
+
+TARGET = '''
+def work(size):
+    total = 0
+    for i in range(size):
+        if i % 3:
+            total += i
+        else:
+            total -= 1
+    return total
+'''
+
+
+def load_target(name, hook=None):
+    """
+    Import name afresh, under hook if given. The hook stays set up, the
+    monitoring engine only records while it is; tear it down when done.
+    """
+    sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    if hook is not None:
+        hook.setup_hook()
+    try:
+        return importlib.import_module(name)
+    except BaseException:
+        if hook is not None:
+            hook.teardown_hook()
+        raise
+
+
+def run_threads(func, threads, calls, size):
+    def worker():
+        for _ in range(calls):
+            func(size)
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--mode', default='probe', choices=OpTraceHook.MODES)
+    parser.add_argument('--engine', default=DEFAULT_ENGINE,
+                        choices=OpTraceHook.ENGINES)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='optrace-bench-')
+    name = 'optrace_bench_threads'
+    with open(os.path.join(directory, name + '.py'), 'w') as file:
+        file.write(TARGET)
+    sys.path.insert(0, directory)
+
+    variants = [('plain', None)]
+    buffered = (False,) if args.engine == 'monitoring' else (False, True)
+    for thread_buffers in buffered:
+        hook = OpTraceHook(
+            [name], mode=args.mode, engine=args.engine,
+            thread_buffers=thread_buffers)
+        variants.append(
+            ('buffers' if thread_buffers else 'shared', hook))
+    targets = [
+        (label, hook, load_target(name, hook).work)
+        for label, hook in variants
+    ]
+
+    print('{: >8} {}'.format('threads', ' '.join(
+        '{: >16}'.format(label) for label, _, _ in targets)))
+    for threads in args.threads:
+        timings = [
+            run_threads(work, threads, args.calls, args.size)
+            for _, _, work in targets
+        ]
+        print('{: >8} {}'.format(threads, ' '.join(
+            '{: >8.3f}s {: >5.2f}x'.format(timing, timing / timings[0])
+            for timing in timings
+        )))
+
+    for label, hook, _ in targets:
+        if hook is not None:
+            hook.teardown_hook()
+            # merging is part of the cost of the buffered variant
+            start = time.perf_counter()
+            for data in hook.module_opcodes.values():
+                data.collect()
+            print('{} collect {:.4f}s'.format(
+                label, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
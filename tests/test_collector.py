@@ -0,0 +1,141 @@
+import socket
+import threading
+import unittest
+
+from OpTrace.collector import (
+    check_message, Collector, CollectorClient, FRAME, HELLO, MAX_FRAME,
+    read_message, send_message)
+from OpTrace.hook import OpTraceHook
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+ROW = [0, 2, 100, 1, 1, 'x', 0]
+
+
+def make_message(rows=(ROW,), probe_ids=(0,), hits=(1,), counting=False):
+    return [counting, [
+        ['m', ['x = 1'], 0, list(rows), list(probe_ids), list(hits)]]]
+
+
+class CheckMessageTest(unittest.TestCase):
+
+    def test_valid(self):
+        check_message(make_message())
+        check_message(make_message(counting=True, hits=[2 ** 64 - 1]))
+        check_message([False, []])
+
+    def test_malformed(self):
+        for message in [
+                None, [], {'a': 1}, [1, []], [False, {}],
+                [False, [['m', None, 0, [], [0]]]],
+                make_message(rows=[ROW[:6]]),
+                make_message(rows=[ROW[:2] + [256] + ROW[3:]]),
+                make_message(rows=[ROW[:5] + [5] + ROW[6:]]),
+                make_message(rows=[[True] + ROW[1:]]),
+                make_message(probe_ids=[-1]),
+                make_message(probe_ids=[0, 1]),
+                make_message(hits=[2 ** 64]),
+                make_message(hits=['1']),
+        ]:
+            with self.assertRaises(ValueError, msg=repr(message)):
+                check_message(message)
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = Collector(('127.0.0.1', 0))
+        self.collector.start()
+        self.addCleanup(self.collector.stop)
+
+    def connect(self, hello=HELLO):
+        sock = socket.create_connection(self.collector.address, timeout=5)
+        self.addCleanup(sock.close)
+        if hello is not None:
+            send_message(sock, hello)
+            with sock.makefile('rb') as file:
+                self.answer = read_message(file)
+        return sock
+
+    def assert_dropped(self, sock):
+        # the collector closes the connection without answering
+        self.assertEqual(sock.recv(1), b'')
+
+    def test_rejects_untrusted_frames(self):
+        # marshal would have built a code object from this
+        for hello in (None, HELLO):
+            sock = self.connect(hello)
+            payload = b'\xe3' + bytes(40)
+            sock.sendall(FRAME.pack(len(payload)) + payload)
+            self.assert_dropped(sock)
+
+            sock = self.connect(hello)
+            sock.sendall(FRAME.pack(MAX_FRAME + 1))
+            self.assert_dropped(sock)
+
+        sock = self.connect()
+        send_message(sock, make_message(probe_ids=[5]))
+        self.assert_dropped(sock)
+        self.assertEqual(self.collector.module_opcodes, {})
+
+    def test_other_python_version(self):
+        sock = self.connect([HELLO[0], '00000d0a'])
+        self.assertEqual(self.answer[0], False)
+        self.assertIn('another Python version', self.answer[1])
+        self.assert_dropped(sock)
+
+        sock = self.connect(make_message())
+        self.assertEqual(
+            self.answer, [False, 'not an OpTrace collector client'])
+        self.assert_dropped(sock)
+
+    def test_client_refused(self):
+        # a collector on another Python version, as seen by the client
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def refuse():
+            sock, _ = server.accept()
+            with sock, sock.makefile('rb') as file:
+                read_message(file)
+                send_message(sock, [False, 'another Python version'])
+        thread = threading.Thread(target=refuse)
+        thread.start()
+
+        hook = OpTraceHook(['m'], mode='probe', snapshots=True)
+        hook.module_opcodes['m'] = FileOpcode('m', [])
+        events = []
+        hook.debug_sink = lambda *event: events.append(event)
+        client = CollectorClient(hook, server.getsockname())
+        self.assertFalse(client.send())
+        thread.join()
+        self.assertEqual(client.refused, 'another Python version')
+        self.assertEqual([event[0] for event in events], ['refused'])
+        # no new connection is tried
+        self.assertFalse(client.send())
+        self.assertEqual(len(events), 1)
+
+    def test_snapshots_left_to_the_client(self):
+        address = self.collector.address
+        with self.assertRaises(ValueError):
+            OpTraceHook(['m'], mode='probe', snapshots=True, collector=address)
+        hook = OpTraceHook(['m'], mode='probe', collector=address)
+        with self.assertRaisesRegex(ValueError, 'collector client'):
+            hook.snapshot()
+
+    def test_adds_valid_messages(self):
+        sock = self.connect()
+        send_message(sock, make_message())
+        send_message(sock, [False, [['m', None, 1, [], [0], [1]]]])
+        sock.shutdown(socket.SHUT_WR)
+        self.assert_dropped(sock)
+        data = self.collector.module_opcodes['m']
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data.visited[0], 1)
+        self.assertEqual(data.source, ['x = 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from array import array
+from importlib.util import MAGIC_NUMBER
+
+from OpTrace.datafile import DataFile
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+class DataFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_data(self):
+        data = FileOpcode('m', ['x = 1', 'y = x'])
+        for offset in range(3):
+            data.add_row(0, offset, 100, offset, 1 + offset // 2, 'x', False)
+        data.visited[1] = 1
+        return data
+
+    def rows(self, data):
+        return [
+            (opcode.codeobj_id, opcode.offset, opcode.opcode, opcode.arg,
+             opcode.starts_line, opcode.argrepr, opcode.is_jump_target,
+             opcode.visited, opcode.count)
+            for opcode in data.iter_opcodes()
+        ]
+
+    def test_bits(self):
+        for flags in ([], [1], [0, 1, 1], [1] + [0] * 7, [0] * 8 + [1]):
+            packed = DataFile.pack_bits(bytearray(flags))
+            self.assertEqual(len(packed), (len(flags) + 7) // 8)
+            self.assertEqual(
+                list(DataFile.unpack_bits(packed, len(flags))), flags)
+
+    def test_round_trip(self):
+        data = self.make_data()
+        data.add_row(1, 0, 1, None, 2, 'y', True)
+        data_file = DataFile(self.directory)
+        data_file.dump({'m': data})
+
+        loaded = {}
+        data_file.load(data_file.path, loaded)
+        self.assertEqual(loaded['m'].source, data.source)
+        self.assertIsNone(loaded['m'].path)
+        self.assertEqual(self.rows(loaded['m']), self.rows(data))
+        self.assertEqual(loaded['m'].code_rows, data.code_rows)
+
+    def test_combine(self):
+        paths = []
+        for visited, counts in ((0, [1, 1, 0]), (2, [0, 2, 5])):
+            data = self.make_data()
+            data.visited[visited] = 1
+            data.counts = array('Q', counts)
+            data_file = DataFile(self.directory)
+            data_file.dump({'m': data})
+            paths.append(data_file.path)
+        other = FileOpcode('other', ['z = 2'])
+        data_file = DataFile(self.directory)
+        data_file.dump({'other': other})
+        paths.append(data_file.path)
+
+        data_file = DataFile(self.directory)
+        self.assertEqual(sorted(data_file.iter_paths()), sorted(paths))
+        entries = data_file.combine(paths)
+        # the two files of m share their metadata, one entry is left
+        self.assertEqual([entry[0] for entry in entries], ['m', 'other'])
+        data_file.write(data_file.path, entries)
+
+        loaded = {}
+        data_file.load(data_file.path, loaded)
+        self.assertEqual(
+            [(opcode.visited, opcode.count)
+             for opcode in loaded['m'].iter_opcodes()],
+            [(True, 1), (True, 3), (True, 5)])
+        self.assertEqual(loaded['other'].source, ['z = 2'])
+        self.assertEqual(len(loaded['other']), 0)
+
+    def test_other_python_version(self):
+        data_file = DataFile(self.directory)
+        data_file.dump({'m': self.make_data()})
+        self.assertEqual(len(list(data_file.read(data_file.path))), 1)
+
+        with open(data_file.path, 'r+b') as file:
+            file.seek(len(DataFile.MAGIC))
+            self.assertEqual(file.read(len(MAGIC_NUMBER)), MAGIC_NUMBER)
+            file.seek(len(DataFile.MAGIC))
+            file.write(b'\x00\x00\r\n')
+        with self.assertRaisesRegex(ValueError, 'another Python version'):
+            list(data_file.read(data_file.path))
+        with self.assertRaisesRegex(ValueError, 'another Python version'):
+            data_file.combine([data_file.path])
+
+    def test_not_a_data_file(self):
+        path = os.path.join(self.directory, 'optrace-1-0.data')
+        with open(path, 'wb') as file:
+            file.write(b'OPTRACE')
+        with self.assertRaisesRegex(ValueError, 'not an OpTrace data file'):
+            list(DataFile().read(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import io
+import json
+import opcode
+import unittest
+
+from array import array
+from xml.etree import ElementTree
+
+from OpTrace.exporters import (
+    CoberturaExporter, JsonExporter, LcovExporter)
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+def make_data():
+    """`x = a` ran, once with counters, `y = b` did not."""
+    data = FileOpcode('pkg.m', ['x = a', 'y = b'])
+    for offset, (name, line, argrepr) in enumerate([
+            ('LOAD_NAME', 1, 'a'), ('STORE_NAME', None, 'x'),
+            ('LOAD_NAME', 2, 'b'), ('STORE_NAME', None, 'y')]):
+        data.add_row(
+            0, 2 * offset, opcode.opmap[name], offset, line, argrepr, False)
+    data.visited[0] = 1
+    return data
+
+
+class ExportersTest(unittest.TestCase):
+
+    def export(self, exporter, counts=None):
+        data = make_data()
+        if counts is not None:
+            data.counts = array('Q', counts)
+        file = io.StringIO()
+        exporter(file).export({'top': FileOpcode('top', []), 'pkg.m': data})
+        return file.getvalue()
+
+    def test_json(self):
+        modules = json.loads(self.export(JsonExporter, [3, 0, 0, 0]))
+        self.assertEqual(
+            [module['module'] for module in modules['modules']],
+            ['pkg.m', 'top'])
+        module = modules['modules'][0]
+        self.assertEqual(module['filename'], 'pkg/m.py')
+        self.assertEqual(module['lines'], [[1, 2, 1, 3], [2, 2, 0, 0]])
+        self.assertEqual(module['missing'], [
+            {'line': 1, 'opname': 'STORE_NAME', 'spans': [[0, 1]]},
+            {'line': 2, 'opname': 'LOAD_NAME', 'spans': [[4, 5]]},
+            {'line': 2, 'opname': 'STORE_NAME', 'spans': [[0, 1]]},
+        ])
+        self.assertEqual(modules['modules'][1]['lines'], [])
+
+    def test_lcov(self):
+        records = self.export(LcovExporter).split('end_of_record\n')
+        self.assertEqual(records[0].splitlines(), [
+            'TN:', 'SF:pkg/m.py',
+            # an opcode that did not run is 0 on a line that ran
+            'BRDA:1,0,0,1', 'BRDA:1,0,1,0',
+            'BRDA:2,0,0,-', 'BRDA:2,0,1,-',
+            'BRF:4', 'BRH:1',
+            'DA:1,1', 'DA:2,0',
+            'LF:2', 'LH:1',
+        ])
+        self.assertEqual(records[1].splitlines(), [
+            'TN:', 'SF:top.py', 'BRF:0', 'BRH:0', 'LF:0', 'LH:0'])
+        self.assertEqual(records[2], '')
+
+    def test_cobertura(self):
+        root = ElementTree.fromstring(
+            self.export(CoberturaExporter, [3, 0, 0, 0]))
+        self.assertEqual(
+            [root.get(name) for name in (
+                'lines-valid', 'lines-covered', 'branches-valid',
+                'branches-covered', 'line-rate', 'branch-rate')],
+            ['2', '1', '4', '1', '0.5000', '0.2500'])
+        packages = root.findall('packages/package')
+        self.assertEqual([package.get('name') for package in packages],
+                         ['', 'pkg'])
+        self.assertEqual(packages[0].get('line-rate'), '1.0000')
+        module = packages[1].find('classes/class')
+        self.assertEqual(module.get('filename'), 'pkg/m.py')
+        self.assertEqual(
+            [line.attrib for line in module.findall('lines/line')], [
+                {'number': '1', 'hits': '3', 'branch': 'true',
+                 'condition-coverage': '50% (1/2)'},
+                {'number': '2', 'hits': '0', 'branch': 'true',
+                 'condition-coverage': '0% (0/2)'},
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from OpTrace.matcher import ModuleMatcher
+
+
+class ModuleMatcherTest(unittest.TestCase):
+
+    def assert_matches(self, patterns, included, excluded):
+        matcher = ModuleMatcher(patterns)
+        for name in included:
+            self.assertIn(name, matcher)
+        for name in excluded:
+            self.assertNotIn(name, matcher)
+
+    def test_exact(self):
+        self.assert_matches(
+            ['pkg.mod'], ['pkg.mod'], ['pkg', 'pkg.mod.sub', 'pkg.other'])
+
+    def test_tree(self):
+        # `pkg.*` is what lies below pkg, its __init__ needs `pkg` too
+        self.assert_matches(
+            ['pkg.*'], ['pkg.a', 'pkg.a.b.c'], ['pkg', 'pkgx.a', 'other'])
+        self.assert_matches(
+            ['pkg', 'pkg.*'], ['pkg', 'pkg.a'], ['pkgx', 'other.pkg'])
+
+    def test_globs(self):
+        self.assert_matches(
+            ['tests.test_*', 'app.?.views'],
+            ['tests.test_a', 'tests.test_', 'app.x.views'],
+            ['tests.helpers', 'tests.test_a.sub', 'app.xy.views', 'tests'])
+        self.assert_matches(
+            ['*.models'], ['a.models', 'b.models'], ['a.b.models', 'models'])
+
+    def test_exclusions(self):
+        self.assert_matches(
+            ['app', 'app.*', '!app.vendor.*', '!app.settings'],
+            ['app', 'app.views', 'app.vendor', 'app.settings.local'],
+            ['app.vendor.six', 'app.vendor.a.b', 'app.settings'])
+        # wins whatever the order and however deep the inclusion
+        self.assert_matches(
+            ['!app.*', 'app.views', 'app.views.*'], [], ['app.views.a'])
+        self.assert_matches(
+            ['app.*', '!app.test_*.*'], ['app.test_a'], ['app.test_a.b'])
+
+    def test_shared_nodes(self):
+        matcher = ModuleMatcher(['a.b', 'a.b.*', 'a.*', 'a.b'])
+        self.assertEqual(list(matcher.root.children), ['a'])
+        self.assertEqual(list(matcher.root.children['a'].children), ['b'])
+        matcher = ModuleMatcher(['a.x*.c', 'a.x*.d'])
+        self.assertEqual(len(matcher.root.children['a'].globs), 1)
+        self.assertIn('a.xy.d', matcher)
+
+    def test_invalid(self):
+        for pattern in ('', 'a..b', '.a', 'a.', '!'):
+            with self.assertRaises(ValueError, msg=pattern):
+                ModuleMatcher([pattern])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+The sys.monitoring engine on a real module; needs Python 3.12+, unlike the
+rest of the tests.
+"""
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from OpTrace.hook import OpTraceHook
+
+
+MODULE = 'optrace_monitoring_target'
+SOURCE = '''\
+def f(n):
+    total = 0
+    for i in range(n):
+        if i % 2:
+            total += i
+    return total
+
+
+def never():
+    return 42
+'''
+
+
+@unittest.skipIf(sys.version_info < (3, 12), 'sys.monitoring is 3.12+')
+class MonitoringTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, MODULE + '.py'), 'w') as file:
+            file.write(SOURCE)
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+
+    def load(self, **options):
+        hook = OpTraceHook([MODULE], engine='monitoring', **options)
+        sys.modules.pop(MODULE, None)
+        self.addCleanup(sys.modules.pop, MODULE, None)
+        hook.setup_hook()
+        self.addCleanup(hook.teardown_hook)
+        return hook, importlib.import_module(MODULE)
+
+    def rows(self, hook):
+        """(line, opname, count or visited) of every row."""
+        data = hook.module_opcodes[MODULE]
+        data.collect()
+        rows = []
+        line = None
+        for opcode in data.iter_opcodes():
+            line = opcode.starts_line or line
+            value = opcode.visited if data.counts is None else opcode.count
+            rows.append((line, opcode.opname, int(value)))
+        return rows
+
+    def test_probe(self):
+        for granularity in ('opcode', 'line', 'branch', 'block'):
+            with self.subTest(granularity=granularity):
+                hook, module = self.load(
+                    mode='probe', granularity=granularity)
+                module.f(3)
+                module.f(3)
+                hook.teardown_hook()
+                rows = self.rows(hook)
+                self.assertTrue(rows)
+                # everything but the body of never() ran
+                self.assertEqual(
+                    [row for row in rows if row[2] != (row[0] != 10)], [])
+
+    def test_count_opcodes(self):
+        for granularity in ('opcode', 'block'):
+            with self.subTest(granularity=granularity):
+                hook, module = self.load(
+                    mode='count', granularity=granularity)
+                module.f(3)
+                hook.teardown_hook()
+                rows = self.rows(hook)
+                self.assertIn((3, 'FOR_ITER', 4), rows)
+                self.assertIn((4, 'BINARY_OP', 3), rows)
+                self.assertEqual(
+                    {count for line, _, count in rows if line == 5}, {1})
+                self.assertEqual(
+                    {count for line, _, count in rows if line == 10}, {0})
+
+    def test_count_lines(self):
+        hook, module = self.load(mode='count', granularity='line')
+        module.f(3)
+        module.f(3)
+        hook.teardown_hook()
+        counts = {}
+        for line, _, count in self.rows(hook):
+            counts.setdefault(line, set()).add(count)
+        self.assertEqual(counts, {
+            1: {1}, 9: {1}, 2: {2}, 3: {8}, 4: {6}, 5: {2}, 6: {2}, 10: {0},
+        })
+
+    def test_count_branches(self):
+        hook, module = self.load(mode='count', granularity='branch')
+        module.f(3)
+        hook.teardown_hook()
+        rows = self.rows(hook)
+        # the loop test, the `if` body it jumps to and the return after
+        self.assertIn((3, 'FOR_ITER', 4), rows)
+        self.assertEqual([row[2] for row in rows if row[0] == 5][0], 1)
+        self.assertEqual([row[2] for row in rows if row[0] == 6], [1])
+
+    def test_restart(self):
+        hook, module = self.load(mode='probe', granularity='line')
+        module.f(1)
+        # the locations that fired were disabled; each context has to see
+        # them fire again
+        hook.set_context('first')
+        module.f(3)
+        hook.set_context('second')
+        module.f(3)
+        hook.set_context(None)
+        self.assertEqual(
+            hook.get_contexts(MODULE, lines=[5]), ['first', 'second'])
+        self.assertEqual(hook.get_contexts(MODULE, lines=[10]), [])
+        module.never()
+        self.assertEqual(hook.get_contexts(MODULE, lines=[10]), [])
+        self.assertEqual(
+            [row[2] for row in self.rows(hook) if row[0] == 10], [1])
+
+    def test_teardown(self):
+        hook, module = self.load(mode='probe', granularity='opcode')
+        hook.teardown_hook()
+        module.never()
+        self.assertEqual(
+            [row[2] for row in self.rows(hook) if row[0] == 10], [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from OpTrace.opcode_resolver import SourceIndex
+
+
+class SourceIndexTest(unittest.TestCase):
+
+    def assert_spans(self, index, expected):
+        for key, spans in expected.items():
+            self.assertEqual(index.spans.get(key), spans, msg=repr(key))
+
+    def test_tokens(self):
+        index = SourceIndex([
+            'x = obj.attr[1] + f(2)',
+            'if a not in b and c is not None:',
+            '    del x',
+        ])
+        self.assert_spans(index, {
+            (0, 'token', '+'): [(16, 17)],
+            (0, 'attr', 'attr'): [(4, 12)],
+            (0, 'subscript', None): [(12, 15)],
+            (0, 'call', None): [(19, 22)],
+            (1, 'token', 'not'): [(5, 8), (23, 26)],
+            (1, 'token', 'not in'): [(5, 11)],
+            (1, 'token', 'is not'): [(20, 26)],
+            (2, 'del', 'x'): [(4, 9)],
+        })
+
+    def test_brackets_and_loops(self):
+        index = SourceIndex([
+            'for i in [y for y in z]:',
+            '    s = {"k": (1,',
+            '         2)}',
+        ])
+        self.assert_spans(index, {
+            (0, 'for', None): [(0, 8), (12, 20)],
+            (0, 'list', None): [(9, 23)],
+            # both close on the next line, so they end with this one
+            (1, 'brace', None): [(8, 17)],
+            (1, 'paren', None): [(14, 17)],
+        })
+
+    def test_nodes(self):
+        index = SourceIndex([
+            'x = obj.attr[1] + f(-2)',
+            'y = "s" if x else -1.5',
+            'z = (a +',
+            '     b)',
+        ])
+        self.assert_spans(index, {
+            (0, 'name', 'obj'): [(4, 7)],
+            (0, 'name', 'attr'): None,
+            (0, 'const', '1'): [(13, 14)],
+            # the folded constant and the one the tokens show
+            (0, 'const', '-2'): [(20, 22)],
+            (0, 'const', '2'): [(21, 22)],
+            (1, 'const', "'s'"): [(4, 7)],
+            (1, 'const', '-1.5'): [(18, 22)],
+            (1, 'name', 'x'): [(11, 12)],
+            (3, 'name', 'b'): [(5, 6)],
+        })
+
+    def test_syntax_error(self):
+        # tokens are still indexed, there is no AST to add names from
+        index = SourceIndex(['x = 1', 'def broken(:'])
+        self.assertEqual(index.find(1, 'token', 'broken'), (4, 10))
+        self.assertIsNone(index.find(0, 'name', 'x'))
+
+    def test_find(self):
+        index = SourceIndex(['a = a + a'])
+        self.assertEqual(index.find(0, 'name', 'a'), (0, 1))
+        self.assertEqual(index.find(0, 'name', 'a', 1), (4, 5))
+        self.assertEqual(index.find(0, 'name', 'a', 5), (8, 9))
+        # past the last span it falls back to the first
+        self.assertEqual(index.find(0, 'name', 'a', 9), (0, 1))
+        self.assertIsNone(index.find(0, 'name', 'b'))
+        self.assertIsNone(index.find(1, 'name', 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import threading
+import unittest
+
+from array import array
+
+from OpTrace.hook import OpTraceHook
+from OpTrace.wrapped_opcode import FileOpcode
+
+
+class ThreadBuffersTest(unittest.TestCase):
+    """Maps of ended threads are folded in and dropped, live ones kept."""
+
+    def run_threads(self, counting):
+        data = FileOpcode('m', [], thread_buffers=True)
+        for offset in range(3):
+            data.add_row(0, offset, 1, None, 1, '', False)
+        hits = array('Q', [0]) * 2 if counting else bytearray(2)
+        data.add_hits(0, hits, [0, 1, 3])
+
+        def record():
+            data.buffers.visited[2] = 1
+            data.buffers.hits_0[0] += 1
+
+        started = threading.Event()
+        stop = threading.Event()
+
+        def keep_running():
+            data.buffers.hits_0[1] += 1
+            started.set()
+            stop.wait()
+
+        running = threading.Thread(target=keep_running)
+        running.start()
+        started.wait()
+        try:
+            for _ in range(50):
+                thread = threading.Thread(target=record)
+                thread.start()
+                thread.join()
+            data.merge()
+            # the running thread's map and the one the others went into
+            self.assertEqual(len(data.thread_hits[0]), 2)
+            self.assertEqual(data.thread_visited, [])
+            self.assertEqual(data.visited[2], 1)
+            self.assertEqual(list(hits), [50 if counting else 1, 1])
+        finally:
+            stop.set()
+            running.join()
+        data.merge()
+        self.assertEqual(len(data.thread_hits[0]), 1)
+        self.assertEqual(list(hits), [50 if counting else 1, 1])
+
+    def test_bitmaps(self):
+        self.run_threads(counting=False)
+
+    def test_counters(self):
+        self.run_threads(counting=True)
+
+
+class SnapshotTest(unittest.TestCase):
+    """Snapshots report each change once, across set_context drains."""
+
+    def make_data(self, counting):
+        data = FileOpcode('m', [])
+        for offset in range(3):
+            data.add_row(0, offset, 1, None, 1, '', False)
+        hits = array('Q', [0]) * 2 if counting else bytearray(2)
+        data.add_hits(0, hits, [0, 1, 3])
+        return data, hits
+
+    def test_probes_after_drain(self):
+        data, hits = self.make_data(counting=False)
+        hits[0] = 1
+        self.assertEqual(data.snapshot([0]), {0: 1})
+        # what set_context does to every module
+        self.assertEqual(data.drain(), 0b1)
+        self.assertEqual(data.snapshot([0]), {})
+        # the same probe again, then a new one
+        hits[0] = 1
+        self.assertEqual(data.snapshot([0]), {})
+        hits[1] = 1
+        self.assertEqual(data.snapshot([0]), {1: 1, 2: 1})
+        self.assertEqual(data.drain(), 0b111)
+        self.assertEqual(data.snapshot([0]), {})
+
+    def test_counters_after_drain(self):
+        data, hits = self.make_data(counting=True)
+        hits[0] = 2
+        self.assertEqual(data.snapshot([0]), {0: 2})
+        data.drain()
+        self.assertEqual(data.snapshot([0]), {})
+        hits[0] = 3
+        self.assertEqual(data.snapshot([0]), {0: 3})
+
+
+
+class ContextBitsTest(unittest.TestCase):
+    """Hits drained into per-context bitsets of probe ids."""
+
+    def make_data(self, counting=False):
+        # code 0 has rows 0-2 on lines 1-2, code 1 row 3 on line 3
+        data = FileOpcode('m', [])
+        for offset, line in enumerate([1, None, 2]):
+            data.add_row(0, offset, 1, None, line, '', False)
+        data.add_row(1, 0, 1, None, 3, '', False)
+        if counting:
+            self.hits = [array('Q', [0]) * 2, array('Q', [0])]
+        else:
+            self.hits = [bytearray(2), bytearray(1)]
+        data.add_hits(0, self.hits[0], [0, 2, 3])
+        data.add_hits(1, self.hits[1], [0, 1])
+        return data
+
+    def test_to_bits(self):
+        self.assertEqual(FileOpcode.to_bits(bytearray()), 0)
+        self.assertEqual(FileOpcode.to_bits(bytearray([1, 0, 1, 1])), 0b1101)
+        self.assertEqual(FileOpcode.to_bits(bytearray(70) + b'\x01'), 1 << 70)
+
+    def test_drain(self):
+        for counting in (False, True):
+            data = self.make_data(counting)
+            self.hits[0][0] = 2 if counting else 1
+            self.hits[1][0] = 1
+            # a slot covers every row of its block
+            self.assertEqual(data.drain(), 0b1011)
+            self.assertEqual(list(self.hits[0]) + list(self.hits[1]), [0] * 3)
+            self.assertEqual(data.drain(), 0)
+            self.hits[0][0] = 1
+            self.assertEqual(data.drain(), 0b11)
+            # drained hits still count once collected
+            data.collect()
+            self.assertEqual(
+                [(opcode.visited, opcode.count)
+                 for opcode in data.iter_opcodes()],
+                [(True, 3), (True, 3), (False, 0), (True, 1)] if counting
+                else [(True, 1), (True, 1), (False, 0), (True, 1)])
+
+    def test_probe_bits(self):
+        data = self.make_data()
+        self.assertEqual(data.get_probe_bits(), 0)
+        # rows without a line start belong to the line above
+        self.assertEqual(data.get_probe_bits(lines=[1]), 0b11)
+        self.assertEqual(data.get_probe_bits(lines=[2, 3]), 0b1100)
+        self.assertEqual(data.get_probe_bits(codeobj_ids=[1]), 0b1000)
+        self.assertEqual(
+            data.get_probe_bits(lines=[2], codeobj_ids=[0]), 0b111)
+
+    def test_contexts(self):
+        hook = OpTraceHook(['m'], mode='probe')
+        hook.module_opcodes['m'] = self.make_data()
+        self.hits[0][1] = 1
+        hook.set_context('a')
+        self.hits[0][0] = 1
+        hook.set_context('b')
+        hook.set_context('c')
+        self.hits[0][0] = 1
+        self.hits[1][0] = 1
+        self.assertEqual(hook.get_contexts('m', lines=[1]), ['a', 'c'])
+        self.assertEqual(hook.get_contexts('m', lines=[2]), [])
+        self.assertEqual(hook.get_contexts('m', codeobj_ids=[1]), ['c'])
+        self.assertEqual(hook.get_contexts('other', lines=[1]), [])
+        self.assertEqual(hook.contexts['c'], {'m': 0b1011})
+
+        with self.assertRaises(ValueError):
+            OpTraceHook(['m'], mode='trace').set_context('a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+Checks of the bytecode layout Wrapper produces, on synthetic instructions
+in the 3.5 format (one byte without an argument, three with one), so they
+run on any Python even though instrumented code only runs on 3.5.
+"""
+import opcode
+import unittest
+
+from collections import namedtuple
+
+from OpTrace.wrapped_opcode import FileOpcode
+from OpTrace.wrapper import Wrapper
+
+
+Instruction = namedtuple('Instruction', (
+    'opname', 'opcode', 'arg', 'argval', 'argrepr', 'offset', 'starts_line',
+    'is_jump_target',
+))
+
+# the name of the conditional jump differs between versions
+COND_JUMP = next(
+    name for name in ('POP_JUMP_IF_FALSE', 'POP_JUMP_FORWARD_IF_FALSE')
+    if name in opcode.opmap
+)
+# absolute backward jump, 3.10 and earlier
+BACK_JUMP = 'JUMP_ABSOLUTE' if 'JUMP_ABSOLUTE' in opcode.opmap and \
+    opcode.opmap['JUMP_ABSOLUTE'] in opcode.hasjabs else None
+
+
+def assemble(program, firstlineno=1):
+    """
+    Instructions and (offset, line) starts of a program of (opname, arg),
+    ('label', name) and ('line', number) items; jumps take a label as arg.
+    Jumps are assumed to fit in 16 bits.
+    """
+    wrapper = Wrapper(None, None)
+    labels = {}
+    line_starts = []
+    offset = 0
+    for item in program:
+        if item[0] == 'label':
+            labels[item[1]] = offset
+        elif item[0] == 'line':
+            line_starts.append((offset, item[1]))
+        else:
+            op = opcode.opmap[item[0]]
+            arg = item[1] if isinstance(item[1], int) else 0
+            offset += wrapper.instruction_len(op, arg)
+
+    instructions = []
+    starts = dict(line_starts)
+    offset = 0
+    for item in program:
+        if item[0] in ('label', 'line'):
+            continue
+        name, arg = item
+        op = opcode.opmap[name]
+        argval = arg
+        if isinstance(arg, str):
+            argval = labels[arg]
+            arg = argval
+            if op in opcode.hasjrel:
+                arg = argval - offset - wrapper.instruction_len(op, 0)
+        start = offset
+        if arg is not None and arg > 0xFFFF:
+            # the EXTENDED_ARG prefix, folded in as get_instructions does
+            offset += 3
+        st = Instruction(
+            name, op, arg, argval, repr(argval), offset, starts.get(start),
+            start in labels.values())
+        instructions.append((start, st))
+        offset = start + wrapper.instruction_len(op, arg or 0)
+    return instructions, line_starts
+
+
+def decode(code):
+    """(start, opcode, arg) of 3.5 format code, EXTENDED_ARG folded in."""
+    result = []
+    offset = 0
+    start = None
+    extended = 0
+    while offset < len(code):
+        op = code[offset]
+        if start is None:
+            start = offset
+        if op < opcode.HAVE_ARGUMENT:
+            arg = None
+            offset += 1
+        else:
+            arg = code[offset + 1] | code[offset + 2] << 8 | extended
+            offset += 3
+        if op == opcode.EXTENDED_ARG:
+            extended = arg << 16
+            continue
+        result.append((start, op, arg))
+        start = None
+        extended = 0
+    return result
+
+
+def decode_lnotab(lnotab, firstlineno):
+    """(offset, line) starts as dis.findlinestarts reads them on 3.5."""
+    starts = []
+    last_line = None
+    line = firstlineno
+    offset = 0
+    for offset_delta, line_delta in zip(lnotab[0::2], lnotab[1::2]):
+        if offset_delta:
+            if line != last_line:
+                starts.append((offset, line))
+                last_line = line
+            offset += offset_delta
+        line += line_delta
+    if line != last_line:
+        starts.append((offset, line))
+    return starts
+
+
+class RelocateTest(unittest.TestCase):
+    # constants past 65535, so every probe needs EXTENDED_ARG
+    CONSTANTS = 70000
+
+    def make_program(self):
+        program = [('line', 1), ('label', 'top')]
+        for index in range(1500):
+            if index % 100 == 50:
+                program.append(('line', 2 + index * 3))
+            program.extend([
+                ('LOAD_CONST', index), ('STORE_FAST', 0),
+                ('LOAD_FAST', 0), (COND_JUMP, 'end'),
+            ])
+        program.append(('LOAD_CONST', self.CONSTANTS - 1))
+        if BACK_JUMP:
+            program.append((BACK_JUMP, 'top'))
+        program.extend([
+            ('JUMP_FORWARD', 'end'), ('POP_TOP', None),
+            ('label', 'end'), ('line', 5000),
+            ('LOAD_CONST', 0), ('RETURN_VALUE', None),
+        ])
+        return assemble(program)
+
+    def wrap(self, instructions):
+        wrapper = Wrapper(None, None, hits_func=lambda *args: None)
+        probes = [
+            bytes(wrapper.make_probe(
+                self.CONSTANTS, self.CONSTANTS + 1,
+                self.CONSTANTS + 2 + index))
+            for index in range(len(instructions))
+        ]
+        code, new_offsets = wrapper.assemble(instructions, probes)
+        return wrapper, probes, code, new_offsets
+
+    def test_jumps_and_extended_args(self):
+        instructions, _ = self.make_program()
+        wrapper, probes, code, new_offsets = self.wrap(instructions)
+        self.assertGreater(len(code), 0xFFFF)
+
+        decoded = decode(code)
+        by_start = {
+            start: index for index, (start, _, _) in enumerate(decoded)}
+        wide_jumps = 0
+        for (start, st), probe in zip(instructions, probes):
+            new_start = new_offsets[start]
+            self.assertEqual(new_offsets[st.offset], new_start)
+            # the instruction and jumps to it start with its probe
+            probe_ops = decode(probe)
+            index = by_start[new_start]
+            self.assertEqual(
+                [item[1:] for item in decoded[index:index + len(probe_ops)]],
+                [item[1:] for item in probe_ops])
+            _, op, arg = decoded[index + len(probe_ops)]
+            self.assertEqual(op, st.opcode)
+            target = wrapper.get_jump_target(st)
+            if target is None:
+                self.assertEqual(arg, st.arg)
+                continue
+            if op in opcode.hasjrel:
+                next_start = decoded[index + len(probe_ops) + 1][0]
+                self.assertEqual(next_start + arg, new_offsets[target])
+            else:
+                self.assertEqual(arg, new_offsets[target])
+            wide_jumps += arg > 0xFFFF
+        # relocation had to grow jumps past 16 bits
+        self.assertGreater(wide_jumps, 0)
+
+    def test_lnotab(self):
+        instructions, line_starts = self.make_program()
+        wrapper, _, _, new_offsets = self.wrap(instructions)
+        lnotab = wrapper.make_lnotab(1, line_starts, new_offsets)
+        self.assertEqual(
+            decode_lnotab(lnotab, 1),
+            [(new_offsets[offset], line) for offset, line in line_starts])
+
+
+class RowsTest(unittest.TestCase):
+    """Rows of each probe and the rows a hit marks, per granularity."""
+
+    PROGRAM = [
+        ('line', 1),
+        ('LOAD_FAST', 0), (COND_JUMP, 'else'),
+        ('line', 2),
+        ('LOAD_CONST', 1), ('STORE_FAST', 1), ('JUMP_FORWARD', 'end'),
+        ('label', 'else'), ('line', 3),
+        # unreported: its line goes to the next row
+        ('POP_TOP', None), ('LOAD_CONST', 2), ('STORE_FAST', 1),
+        ('label', 'end'), ('line', 4),
+        ('LOAD_FAST', 1), ('RETURN_VALUE', None),
+    ]
+
+    def mark(self, granularity, counters=False):
+        data = FileOpcode('m', [])
+        wrapper = Wrapper(
+            None, lambda codeobj_id, st: data.add(codeobj_id, st.offset, st),
+            data.add_hits, granularity=granularity, counters=counters)
+        instructions, _ = assemble(self.PROGRAM)
+        blocks, probe_ids, hits = wrapper.mark_blocks(0, instructions)
+        rows = [[st.offset for st in block_rows] for _, block_rows in blocks]
+        return data, rows, probe_ids, hits
+
+    def visited(self, data):
+        return [
+            (opcode.opname[data.ops[probe_id]], data.offsets[probe_id],
+             data.lines[probe_id], data.counts[probe_id]
+             if data.counts is not None else data.visited[probe_id])
+            for probe_id in range(len(data))
+        ]
+
+    def test_block_rows(self):
+        data, rows, probe_ids, hits = self.mark('block')
+        self.assertEqual(rows, [[0, 3], [6, 9, 12], [16, 19], [22, 25]])
+        # rows of a block have consecutive probe ids
+        self.assertEqual(
+            probe_ids, [[0, 1], [2, 3, 4], [5, 6], [7, 8]])
+        hits[0] = hits[2] = hits[3] = 1
+        data.collect()
+        self.assertEqual(self.visited(data), [
+            ('LOAD_FAST', 0, 1, 1), (COND_JUMP, 3, 0, 1),
+            ('LOAD_CONST', 6, 2, 0), ('STORE_FAST', 9, 0, 0),
+            ('JUMP_FORWARD', 12, 0, 0),
+            ('LOAD_CONST', 16, 3, 1), ('STORE_FAST', 19, 0, 1),
+            ('LOAD_FAST', 22, 4, 1), ('RETURN_VALUE', 25, 0, 1),
+        ])
+
+    def test_block_counts(self):
+        data, _, _, hits = self.mark('block', counters=True)
+        hits[0], hits[1], hits[3] = 3, 1, 3
+        data.collect()
+        self.assertEqual(
+            [row[3] for row in self.visited(data)],
+            [3, 3, 1, 1, 1, 0, 0, 3, 3])
+
+    def test_branch_rows(self):
+        data, rows, _, hits = self.mark('branch')
+        # jumps, their targets (the POP_TOP target stands for the next row)
+        # and what follows them; nothing else
+        self.assertEqual(rows, [[3], [6], [12], [16], [22]])
+        hits[1] = hits[2] = 1
+        data.collect()
+        self.assertEqual(self.visited(data), [
+            (COND_JUMP, 3, 1, 0), ('LOAD_CONST', 6, 2, 1),
+            ('JUMP_FORWARD', 12, 0, 1), ('LOAD_CONST', 16, 3, 0),
+            ('LOAD_FAST', 22, 4, 0),
+        ])
+
+    def test_line_rows(self):
+        _, rows, _, _ = self.mark('line')
+        self.assertEqual(rows, [[0, 3], [6, 9, 12], [16, 19], [22, 25]])
+
+    def test_without_jumps(self):
+        data = FileOpcode('m', [])
+        wrapper = Wrapper(
+            None, lambda codeobj_id, st: data.add(codeobj_id, st.offset, st),
+            data.add_hits, granularity='branch')
+        instructions, _ = assemble([
+            ('line', 1), ('LOAD_CONST', 0), ('RETURN_VALUE', None)])
+        blocks, _, _ = wrapper.mark_blocks(0, instructions)
+        self.assertEqual(blocks, [])
+        data.collect()
+        self.assertEqual(data.completed(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()